@@ -0,0 +1,159 @@
+"""Mesure la durée de build_deployment_manager, séquentiel contre concurrent, sur une infrastructure simulée.
+
+Usage : python benchmarks/build_time.py [--runs N] [--latency MS] [--repositories 10 --repositories 50]
+                                        [--services-per-repository N]
+
+Les clients AWS sont remplacés (clients.set_client) par des faux clients qui répondent depuis une topologie
+générée (load balancer, règles, target groups, repositories, services blue/green) après une latence fixe
+par appel. boto3 n'est pas nécessaire. Le script affiche le temps médian de chaque mode et le gain.
+"""
+import argparse
+import itertools
+import os
+import statistics
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from lcdp_deployment_manager import clients, constant  # noqa: E402
+from lcdp_deployment_manager.deployment_manager_factory import build_deployment_manager  # noqa: E402
+
+DEFAULT_REPOSITORIES = (10, 50)
+WORKSPACE = 'bench'
+ALB_NAME = 'bench-alb'
+ALB_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:1:loadbalancer/app/bench-alb/1'
+LISTENER_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:1:listener/app/bench-alb/1/1'
+
+__cluster_ids = itertools.count(1)
+
+
+class FakeClient:
+    """Répond aux appels boto3 utilisés par la découverte, après latency secondes par appel (et par page)."""
+
+    def __init__(self, infrastructure, latency):
+        self.infrastructure = infrastructure
+        self.latency = latency
+
+    def __call(self, result):
+        time.sleep(self.latency)
+        return result
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(self, getattr(self.infrastructure, 'list_' + operation_name))
+
+    def describe_load_balancers(self, Names):
+        return self.__call({'LoadBalancers': [{'LoadBalancerArn': ALB_ARN, 'LoadBalancerName': Names[0]}]})
+
+    def describe_listeners(self, LoadBalancerArn):
+        return self.__call({'Listeners': [self.infrastructure.listener]})
+
+    def describe_tags(self, ResourceArns):
+        return self.__call({'TagDescriptions': [{'ResourceArn': arn, 'Tags': self.infrastructure.tags.get(arn, [])}
+                                                for arn in ResourceArns]})
+
+    def describe_services(self, cluster, services, include=None):
+        return self.__call({'services': [self.infrastructure.services[arn] for arn in services]})
+
+
+class FakePaginator:
+    def __init__(self, client, list_items):
+        self.client = client
+        self.list_items = list_items
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        items, result_key = self.list_items(**kwargs)
+        page_size = (PaginationConfig or {}).get('PageSize') or 100
+        for i in range(0, max(len(items), 1), page_size):
+            time.sleep(self.client.latency)
+            yield {result_key: items[i:i + page_size]}
+
+
+class FakeInfrastructure:
+    """Topologie simulée : une règle et un repository par service applicatif, services_per_repository
+    services ECS par couleur et par repository, un target group par couleur."""
+
+    def __init__(self, cluster_name, repositories, services_per_repository):
+        self.cluster_name = cluster_name
+        self.target_groups = {}
+        self.tags = {}
+        for color in (constant.BLUE, constant.GREEN):
+            arn = 'arn:aws:elasticloadbalancing:eu-west-1:1:targetgroup/bench-{}/1'.format(color)
+            self.target_groups[color] = arn
+            self.tags[arn] = [{'Key': 'Type', 'Value': 'default'}, {'Key': 'Color', 'Value': color}]
+        self.listener = {
+            'ListenerArn': LISTENER_ARN, 'Protocol': 'HTTP', 'Port': 80,
+            'DefaultActions': [self.__forward(constant.BLUE)],
+        }
+
+        self.repository_names = ['{}bench-{}'.format(constant.ECR_SERVICE_PREFIX, i) for i in range(repositories)]
+        self.rules = [{
+            'RuleArn': '{}/rule/{}'.format(LISTENER_ARN, i), 'Priority': str(i + 1), 'IsDefault': False,
+            'Conditions': [{'Field': 'host-header', 'HostHeaderConfig': {'Values': ['{}.bench.verde'.format(name)]}}],
+            'Actions': [self.__forward(constant.BLUE)],
+        } for i, name in enumerate(self.repository_names)]
+        for rule in self.rules:
+            self.tags[rule['RuleArn']] = []
+
+        self.services = {}
+        for name, color, i in itertools.product(self.repository_names, (constant.BLUE, constant.GREEN),
+                                                range(services_per_repository)):
+            arn = 'arn:aws:ecs:eu-west-1:1:service/{}/{}-{}-{}'.format(cluster_name, name, color, i)
+            self.services[arn] = {'serviceArn': arn, 'tags': [{'key': 'MaxCapacity', 'value': '4'}]}
+
+    def __forward(self, color):
+        return {'Type': 'forward', 'TargetGroupArn': self.target_groups[color]}
+
+    def list_describe_rules(self, ListenerArn):
+        default_rule = {'RuleArn': LISTENER_ARN + '/rule/default', 'Priority': 'default', 'IsDefault': True,
+                        'Conditions': [], 'Actions': self.listener['DefaultActions']}
+        return self.rules + [default_rule], 'Rules'
+
+    def list_describe_repositories(self):
+        return [{'repositoryName': name} for name in self.repository_names], 'repositories'
+
+    def list_list_images(self, repositoryName, filter=None):
+        return [{'imageTag': tag, 'imageDigest': 'sha256:{}'.format(repositoryName)}
+                for tag in ('latest', constant.BLUE.upper())], 'imageIds'
+
+    def list_list_services(self, cluster):
+        return list(self.services), 'serviceArns'
+
+    def list_get_resources(self, TagFilters, ResourceTypeFilters):
+        color = next(f['Values'][0] for f in TagFilters if f['Key'] == 'Color')
+        return [{'ResourceARN': self.target_groups[color]}], 'ResourceTagMappingList'
+
+
+def measure(repositories, services_per_repository, latency, concurrent, runs):
+    timings = []
+    for _ in range(runs):
+        # Un cluster différent à chaque mesure : l'inventaire ECS mis en cache n'est pas réutilisé
+        cluster_name = 'bench-{}'.format(next(__cluster_ids))
+        client = FakeClient(FakeInfrastructure(cluster_name, repositories, services_per_repository), latency)
+        for service_name in ('elbv2', 'ecr', 'ecs', 'resourcegroupstaggingapi', 'application-autoscaling'):
+            clients.set_client(service_name, client)
+        start = time.perf_counter()
+        build_deployment_manager(ALB_NAME, cluster_name, 'latest', False, WORKSPACE, concurrent=concurrent)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=20, help='latence simulée par appel AWS, en ms')
+    parser.add_argument('--repositories', type=int, action='append')
+    parser.add_argument('--services-per-repository', type=int, default=1)
+    args = parser.parse_args()
+
+    for repositories in args.repositories or DEFAULT_REPOSITORIES:
+        sequential = measure(repositories, args.services_per_repository, args.latency / 1000, False, args.runs)
+        concurrent = measure(repositories, args.services_per_repository, args.latency / 1000, True, args.runs)
+        print('{:>4} repositories, {:>4} services  sequential {:>9.1f} ms  concurrent {:>9.1f} ms  x{:.1f}'.format(
+            repositories, repositories * args.services_per_repository * 2, sequential * 1000, concurrent * 1000,
+            sequential / concurrent))
+
+
+if __name__ == '__main__':
+    main()
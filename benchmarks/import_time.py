@@ -0,0 +1,56 @@
+"""Mesure le coût d'import du package dans un interpréteur neuf (cas d'un cold start Lambda).
+
+Usage : python benchmarks/import_time.py [--runs N] [--statement "import lcdp_deployment_manager"]
+
+Chaque mesure est faite dans un sous-processus. Le script affiche le temps médian de l'instruction
+et indique si boto3 / botocore ont été importés par celle-ci.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(elapsed, int('boto3' in sys.modules), int('botocore' in sys.modules))
+"""
+
+DEFAULT_STATEMENTS = (
+    'import lcdp_deployment_manager',
+    'from lcdp_deployment_manager import constant, common',
+    'from lcdp_deployment_manager import build_deployment_manager',
+)
+
+
+def measure(statement, runs):
+    timings = []
+    boto3_loaded = botocore_loaded = False
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', MEASURE_SCRIPT, statement], cwd=ROOT_DIR)
+        elapsed, boto3_flag, botocore_flag = output.split()
+        timings.append(float(elapsed))
+        boto3_loaded = boto3_loaded or bool(int(boto3_flag))
+        botocore_loaded = botocore_loaded or bool(int(botocore_flag))
+    return statistics.median(timings), boto3_loaded, botocore_loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--statement', action='append', dest='statements')
+    args = parser.parse_args()
+
+    for statement in args.statements or DEFAULT_STATEMENTS:
+        median, boto3_loaded, botocore_loaded = measure(statement, args.runs)
+        print('{:<60} {:>9.2f} ms  boto3={} botocore={}'.format(
+            statement, median * 1000, boto3_loaded, botocore_loaded))
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,41 @@
-from lcdp_deployment_manager.deployment_manager import DeploymentManager, Environment, EcsService, Repository
+import importlib
+
+# API publique du package, chargée à la demande : importer le package n'importe ni les sous-modules ni boto3.
+# Nom exporté -> sous-module qui le définit
+__lazy_attributes = {
+    'DeploymentManager': 'deployment_manager',
+    'Environment': 'deployment_manager',
+    'EcsService': 'deployment_manager',
+    'Repository': 'deployment_manager',
+    'build_deployment_manager': 'deployment_manager_factory',
+    'build_service': 'deployment_manager_factory',
+    'ensure_environment_is_shut_down': 'deployment_executor',
+    'start_environment_and_wait_for_health': 'deployment_executor',
+    'release_matched_capacity': 'deployment_executor',
+    'warm_up_environment': 'deployment_executor',
+    'do_balancing': 'deployment_executor',
+    'do_progressive_balancing': 'deployment_executor',
+    'deploy_services_of_repositories_name': 'deployment_executor',
+    'deploy_pipelined': 'deployment_executor',
+    'deploy_changed_services': 'deployment_executor',
+    'get_services_with_changed_image': 'deployment_executor',
+    'get_client': 'clients',
+    'set_client': 'clients',
+    'tracer': 'instrumentation',
+}
+
+__all__ = list(__lazy_attributes)
+
+
+def __getattr__(name):
+    module_name = __lazy_attributes.get(name)
+    if module_name is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module('.' + module_name, __name__), name)
+    # Mis en cache dans le package : __getattr__ n'est plus appelé pour ce nom
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
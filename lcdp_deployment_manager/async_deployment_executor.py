@@ -0,0 +1,156 @@
+import asyncio
+import functools
+import threading
+
+from . import constant as constant
+from . import deployment_executor as deployment_executor
+from . import instrumentation as instrumentation
+
+###
+#   Moteur de déploiement asyncio, à côté de deployment_executor (à base de threads)
+#   Les appels boto3 restent bloquants : ils sont exécutés dans un pool de threads partagé, dimensionné comme le pool
+#   de connexions des clients, un appel par service et par await. Les attentes (jobs smuggler, arrêt, santé) exécutent
+#   les mêmes pollers que deployment_executor, avec des attentes asyncio : elles peuvent être annulées entre deux
+#   vérifications et sont bornées par une échéance globale.
+#   Usage : asyncio.run(deploy(deployment_manager))
+###
+
+DEPLOYMENT_DEADLINE = 840  # 14 minutes, laisse une marge sous le timeout de 15 minutes de la Lambda
+START_MAX_CONCURRENCY = constant.ECS_START_MAX_WORKERS
+
+__thread_pool = None
+__thread_pool_lock = threading.Lock()
+
+
+def __get_thread_pool():
+    global __thread_pool
+    with __thread_pool_lock:
+        if __thread_pool is None:
+            __thread_pool = instrumentation.TracedThreadPoolExecutor(
+                max_workers=constant.CLIENT_MAX_POOL_CONNECTIONS, thread_name_prefix='lcdp-async')
+        return __thread_pool
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call in the shared thread pool. Cancelling the awaiting task stops waiting for the
+    result, the call itself runs to completion in its thread."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(__get_thread_pool(), functools.partial(func, *args, **kwargs))
+
+
+async def gather_or_cancel(*awaitables):
+    """Run awaitables concurrently and return their results. The first failure cancels the others, then is raised."""
+    tasks = [asyncio.ensure_future(a) for a in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def with_deadline(awaitable, timeout, phase):
+    """Await with a deadline; on expiry the awaitable is cancelled and an exception naming the phase is raised."""
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise Exception("Unable to deploy, {} did not complete within {}s".format(phase, timeout))
+
+
+async def run_poller(poller):
+    """Run a poller (see common.run_poller) with asyncio sleeps: each check runs in the thread pool, the waits
+    between checks are asyncio sleeps, so cancellation takes effect between two checks."""
+    while True:
+        sleeping_time = await run_blocking(next, poller, None)
+        if sleeping_time is None:
+            return
+        await asyncio.sleep(sleeping_time)
+
+
+async def run_each(func, services, max_concurrency):
+    """Call func on every service, each call a separate await with at most max_concurrency in flight:
+    a cancellation stops the services not yet sent."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(service):
+        async with semaphore:
+            await run_blocking(func, service)
+
+    await gather_or_cancel(*(run(service) for service in services))
+
+
+async def wait_for_active_jobs_to_complete(environment):
+    await run_poller(deployment_executor.iter_active_jobs_checks(environment))
+
+
+# Eteint tous les services d'un environnement et attend qu'il n'ait plus aucune tâche
+async def shutdown_environment(environment, max_concurrency=START_MAX_CONCURRENCY):
+    print("Sending shutdown to {} services in {} environment".format(
+        len(environment.ecs_services), environment.color))
+    await run_each(lambda s: s.shutdown(), environment.ecs_services, max_concurrency)
+    # Wait for all service receive shutdown
+    await asyncio.sleep(10)
+    await run_poller(deployment_executor.iter_shutdown_checks(environment, environment.ecs_services))
+
+
+async def ensure_environment_is_shut_down(environment):
+    await wait_for_active_jobs_to_complete(environment)
+    await shutdown_environment(environment)
+
+
+# Démarre tous les services d'un environnement (au plus max_concurrency update_service à la fois, puis un suivi de
+# stabilité groupé) et attend qu'ils soient healthy
+async def start_environment_and_wait_for_health(environment, verify_rollout=False, match_capacity_of=None,
+                                                max_concurrency=START_MAX_CONCURRENCY,
+                                                readiness=constant.READINESS_TASKS,
+                                                min_healthy_targets=constant.MINIMUM_HEALTHY_DESIRED_COUNT,
+                                                target_group_arns=None):
+    if verify_rollout:
+        environment.enable_rollout_verification()
+    desired_counts = {}
+    if match_capacity_of is not None:
+        desired_counts = await run_blocking(environment.get_desired_counts_matching, match_capacity_of)
+    print("Starting all {} services in {} environment".format(len(environment.ecs_services), environment.color))
+    await run_each(lambda s: s.request_new_deployment(), environment.ecs_services, max_concurrency)
+    await run_poller(environment.iter_services_stable_checks(environment.ecs_services,
+                                                             desired_counts=desired_counts))
+    # Wait for all service receive startup
+    await asyncio.sleep(10)
+    if readiness == constant.READINESS_TARGET_GROUP:
+        await run_poller(environment.iter_target_group_health_checks(min_healthy_targets, target_group_arns))
+    else:
+        await run_poller(environment.iter_services_health_checks())
+
+
+async def deploy(deployment_manager, deadline=DEPLOYMENT_DEADLINE, verify_rollout=False, match_capacity=False):
+    """Deploy the image tagged for the inactive environment and switch traffic to it, within a global deadline.
+    The inactive environment starts and is health-checked while the smuggler jobs of the active one drain; the
+    switch waits for both, and a failure of either cancels the other. After the switch, the previous environment
+    gets a short residual job check and is shut down."""
+    active_environment = deployment_manager.get_active_environment()
+    inactive_environment = deployment_manager.get_inactive_environment()
+
+    async def pipeline():
+        await ensure_environment_is_shut_down(inactive_environment)
+        await run_blocking(deployment_manager.add_tag_to_repositories, inactive_environment.color.upper())
+        await gather_or_cancel(
+            start_environment_and_wait_for_health(inactive_environment, verify_rollout,
+                                                  active_environment if match_capacity else None),
+            wait_for_active_jobs_to_complete(active_environment),
+        )
+        await run_blocking(deployment_executor.do_balancing, deployment_manager, active_environment,
+                           inactive_environment)
+        release_error = None
+        if match_capacity:
+            try:
+                await run_blocking(deployment_executor.release_matched_capacity, inactive_environment)
+            except Exception as err:
+                # Comme deploy_pipelined : l'ancien environnement est arrêté avant de lever l'erreur
+                release_error = err
+        await ensure_environment_is_shut_down(active_environment)
+        if release_error is not None:
+            raise release_error
+
+    with instrumentation.span('async_deploy'):
+        await with_deadline(pipeline(), deadline, 'deployment')
@@ -0,0 +1,70 @@
+import threading
+
+from . import constant as constant
+from . import instrumentation as instrumentation
+
+###
+#   Registre des clients boto3 partagés par tous les modules
+#   Les clients sont créés au premier usage, depuis une seule session, avec un pool de connexions dimensionné
+#   pour nos pools de threads et des retries adaptatifs. Un client peut être injecté (ex: stub de test).
+###
+__session = None
+__clients = {}
+__lock = threading.Lock()
+
+
+def get_session():
+    global __session
+    with __lock:
+        if __session is None:
+            # boto3 n'est importé qu'à la création du premier client
+            import boto3
+            __session = boto3.session.Session()
+        return __session
+
+
+def set_session(session):
+    """Use the given boto3 session for the clients created from now on."""
+    global __session
+    with __lock:
+        __session = session
+
+
+# Récupère le client d'un service AWS (et d'une région), créé au premier appel puis partagé
+def get_client(service_name, region_name=None):
+    key = (service_name, region_name)
+    client = __clients.get(key)
+    if client is None:
+        session = get_session()
+        with __lock:
+            client = __clients.get(key)
+            if client is None:
+                client = instrumentation.instrument_client(
+                    session.client(service_name, region_name=region_name, config=__build_config()))
+                __clients[key] = client
+    return client
+
+
+def set_client(service_name, client, region_name=None):
+    """Inject a client, returned by get_client instead of creating one."""
+    with __lock:
+        __clients[(service_name, region_name)] = client
+
+
+def reset_clients():
+    """Forget every client and the session, the next get_client creates them again."""
+    global __session
+    with __lock:
+        __clients.clear()
+        __session = None
+
+
+def __build_config():
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=constant.CLIENT_MAX_POOL_CONNECTIONS,
+        retries={
+            'mode': 'adaptive',
+            'max_attempts': constant.CLIENT_MAX_ATTEMPTS,
+        },
+    )
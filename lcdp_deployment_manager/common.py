@@ -1,3 +1,5 @@
+import time
+
 from .constant import *
 
 
@@ -25,3 +27,74 @@ def get_color_tag(tags):
     for tag in tags:
         if tag['Key'].upper() == TARGET_GROUP_COLOR_TAG_NAME.upper():
             return tag['Value']
+
+
+# Extrait le nom du repository d'une image (ex: 721041490777.dkr.ecr.us-east-1.amazonaws.com/lcdp-api-gateway:BLUE)
+def get_repository_name_from_image(image):
+    return image.split('/')[-1].split(':')[0].split('@')[0]
+
+
+# Récupère les target groups (arn -> poids) d'une action forward, simple ou pondérée
+def get_forward_target_group_weights(action):
+    if action.get('ForwardConfig'):
+        return {tg['TargetGroupArn']: tg.get('Weight', 1) for tg in action['ForwardConfig']['TargetGroups']}
+    if action.get('TargetGroupArn'):
+        return {action['TargetGroupArn']: 1}
+    return {}
+
+
+# Parcourt paresseusement les éléments d'une opération boto3 paginée
+# page_size fixe la taille des pages demandées à AWS, max_items arrête le parcours après ce nombre d'éléments.
+# Les pages sont récupérées au fil de l'itération : un appelant qui s'arrête tôt ne charge pas les suivantes.
+def paginate(client, operation_name, result_key, page_size=None, max_items=None, **kwargs):
+    pagination_config = {}
+    if page_size:
+        pagination_config['PageSize'] = page_size
+    if max_items:
+        pagination_config['MaxItems'] = max_items
+    paginator = client.get_paginator(operation_name)
+    for page in paginator.paginate(PaginationConfig=pagination_config, **kwargs):
+        for item in page[result_key]:
+            yield item
+
+
+# Exécute un poller jusqu'à son terme : un générateur qui fait un tour de vérification à chaque itération et
+# donne le nombre de secondes à attendre avant le suivant. Il se termine quand la condition est atteinte et lève
+# une exception à son échéance. Retourne la valeur retournée par le poller.
+# Le moteur asyncio exécute les mêmes pollers, avec une attente asyncio.
+# stop_event (threading.Event) arrête l'attente plus tôt, entre deux tours (ex: échec d'une phase concurrente).
+def run_poller(poller, stop_event=None):
+    while True:
+        try:
+            sleeping_time = next(poller)
+        except StopIteration as stop:
+            return stop.value
+        if stop_event is None:
+            time.sleep(sleeping_time)
+        elif stop_event.wait(sleeping_time):
+            return None
+
+
+# Découpe une liste en morceaux de taille maximale donnée
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Décrit des services ECS par lots de 10 et les indexe par arn
+def describe_services(client, cluster_name, services_arn, include=None):
+    kwargs = {'include': include} if include else {}
+    services_by_arn = {}
+    for chunk in chunks(list(services_arn), ECS_MAX_SERVICES_PER_DESCRIBE):
+        response = client.describe_services(cluster=cluster_name, services=chunk, **kwargs)
+        for service in response['services']:
+            services_by_arn[service['serviceArn']] = service
+    return services_by_arn
+
+
+# Décrit des tâches ECS par lots de 100
+def describe_tasks(client, cluster_name, tasks_arn):
+    tasks = []
+    for chunk in chunks(list(tasks_arn), ECS_MAX_TASKS_PER_DESCRIBE):
+        tasks.extend(client.describe_tasks(cluster=cluster_name, tasks=chunk)['tasks'])
+    return tasks
@@ -7,6 +7,9 @@ GREEN = 'green'
 # LISTENER
 HTTPS_TUPLE = ('HTTPS', 443)
 HTTP_TUPLE = ('HTTP', 80)
+ALB_MAX_RULE_PRIORITY = 50000
+SWITCH_MAX_WORKERS = 10
+SWITCH_MAX_ATTEMPTS = 2
 
 # Target group
 TARGET_GROUP_COLOR_TAG_NAME = 'Color'
@@ -22,6 +25,7 @@ TARGET_GROUP_SCOPE_API = 'api'
 
 # ECR
 ECR_SERVICE_PREFIX = 'lcdp-'
+ECR_LIST_IMAGES_PAGE_SIZE = 1000
 
 # ECS
 MINIMUM_HEALTHY_DESIRED_COUNT = 1
@@ -29,12 +33,38 @@ DEFAULT_DESIRED_COUNT = 2
 DEFAULT_MAX_CAPACITY = 4
 HEALTHCHECK_RETRY_LIMIT = 26
 HEALTHCHECK_SLEEPING_TIME = 30
+HEALTHCHECK_INITIAL_SLEEPING_TIME = 5
+HEALTHCHECK_BACKOFF_FACTOR = 1.5
+HEALTHCHECK_TIMEOUT = HEALTHCHECK_RETRY_LIMIT * HEALTHCHECK_SLEEPING_TIME
 ECS_SERVICE_NAMESPACE = 'ecs'
+ECS_MAX_SERVICES_PER_DESCRIBE = 10
+ECS_MAX_TASKS_PER_DESCRIBE = 100
+ECS_INVENTORY_TTL = 300
+ECS_START_MAX_WORKERS = 10
+# Readiness : santé des tâches ECS service par service, ou santé des cibles des target groups
+READINESS_TASKS = 'tasks'
+READINESS_TARGET_GROUP = 'target_group'
+SERVICES_STABLE_DELAY = 10  # secondes entre deux vérifications de stabilité
+SERVICES_STABLE_MAX_ATTEMPTS = 30  # timeout après 5 minutes
+
+# Factory
+BUILD_MAX_WORKERS = 10
+SNAPSHOT_DIRECTORY = '/tmp'
+SNAPSHOT_VERSION = 1
+
+# Clients
+# Le pool de connexions couvre le plus grand pool de threads (un thread par service au démarrage)
+CLIENT_MAX_POOL_CONNECTIONS = 50
+CLIENT_MAX_ATTEMPTS = 10
+
+# Instrumentation
+TRACE_EMF_NAMESPACE = 'LCDP-DEPLOYMENT'
 
 # SES
 FROM_MAIL = 'no-reply@lecomptoirdespharmacies.fr'
 DEVELOPERS_MAIL = 'webmaster@lecomptoirdespharmacies.fr'
 DEFAULT_CHARSET = 'UTF-8'
+SES_REGION = 'eu-central-1'
 
 # ASG
 DEFAULT_SCALABLE_DIMENSION = 'ecs:service:DesiredCount'
@@ -1,16 +1,47 @@
+import math
+import threading
 import time
+import urllib.error
+import urllib.request
 
+from concurrent.futures import FIRST_EXCEPTION, wait
+
+from . import common as common
 from . import constant as constant
+from . import instrumentation as instrumentation
+from . import manage_alb as alb_manager
+from . import manage_cloudwatch as cloudwatch_manager
 from . import manage_ecs as ecs_manager
 
 
 SHUTDOWN_CHECK_INTERVAL = 15  # secondes entre chaque verification
+SHUTDOWN_INITIAL_CHECK_INTERVAL = 2  # premier intervalle du suivi de l'arret, augmente ensuite jusqu'a SHUTDOWN_CHECK_INTERVAL
+SHUTDOWN_BACKOFF_FACTOR = 1.5
 SHUTDOWN_TIMEOUT = 900  # 15 minutes max, correspond au timeout max de la Lambda
 SMUGGLER_JOBS_TIMEOUT = 600  # 10 minutes max, laisse assez de temps pour le shutdown + health check dans le timeout Lambda
+CANARY_STEPS = (5, 25, 50, 100)  # pourcentage du trafic envoye au nouvel environnement a chaque etape
+CANARY_HOLD_TIME = 60  # secondes de maintien a chaque etape intermediaire
+CANARY_CHECK_INTERVAL = 15  # secondes entre deux verifications pendant le maintien
+CANARY_MAX_P95_LATENCY = 2.0  # secondes
+CANARY_MAX_5XX_RATE = 0.05  # part des requetes en erreur 5xx
+WARM_UP_PATHS = ('/',)  # requetes synthetiques envoyees a chaque host colore
+WARM_UP_REQUESTS_PER_ROUND = 20
+WARM_UP_P95_TARGET = 0.5  # secondes, la bascule attend que le p95 d'un tour passe sous ce seuil
+WARM_UP_TIMEOUT = 180  # secondes
+WARM_UP_REQUEST_TIMEOUT = 10  # secondes
+WARM_UP_MAX_WORKERS = 10
+REDEPLOY_MAX_WORKERS = 5  # services redemarres en parallele, reste sous la limite de debit de UpdateService
+
 
+@instrumentation.traced
+def _wait_for_active_jobs_to_complete(environment, stop_event=None):
+    """Wait for all smuggler jobs to complete before shutting down, max 10 minutes.
+    Setting stop_event ends the wait early (used when a concurrent phase of the pipeline failed)."""
+    common.run_poller(iter_active_jobs_checks(environment), stop_event)
 
-def _wait_for_active_jobs_to_complete(environment):
-    """Wait for all smuggler jobs to complete before shutting down, max 10 minutes."""
+
+# Poller de _wait_for_active_jobs_to_complete (cf. common.run_poller), partagé avec le moteur asyncio
+def iter_active_jobs_checks(environment):
     start_time = time.time()
     while True:
         metrics = environment.get_active_and_pending_smuggler_jobs()
@@ -34,37 +65,50 @@ def _wait_for_active_jobs_to_complete(environment):
             )
 
         print("Waiting for smuggler jobs to complete: {} active ({}s / {}s)".format(active_jobs, elapsed, SMUGGLER_JOBS_TIMEOUT))
-        time.sleep(SHUTDOWN_CHECK_INTERVAL)
+        yield SHUTDOWN_CHECK_INTERVAL
 
 
-def ensure_environment_is_shut_down(environment):
-    """Ensure all services in the environment have 0 running tasks before proceeding.
+@instrumentation.traced
+def ensure_environment_is_shut_down(environment, services=None):
+    """Ensure all services in the environment (or the given subset) have 0 running tasks before proceeding.
     This prevents old version tasks from coexisting with new ones after image tags are updated."""
+    target_services = services if services is not None else environment.ecs_services
     _wait_for_active_jobs_to_complete(environment)
 
-    print("Sending shutdown to all {} services in {} environment".format(
-        len(environment.ecs_services), environment.color))
-    environment.shutdown_services()
+    print("Sending shutdown to {} services in {} environment".format(len(target_services), environment.color))
+    with instrumentation.span('shutdown_services'):
+        environment.shutdown_services(target_services)
+
+    with instrumentation.span('shutdown_poll'):
+        common.run_poller(iter_shutdown_checks(environment, target_services))
 
+
+# Poller d'arrêt (cf. common.run_poller), partagé avec le moteur asyncio
+# Un tour compte les tâches de tous les services en quelques appels groupés ; un service confirmé à 0 n'est
+# plus interrogé. L'intervalle commence court pour terminer dès que le compte atteint 0.
+def iter_shutdown_checks(environment, services):
     start_time = time.time()
-    while (time.time() - start_time) < SHUTDOWN_TIMEOUT:
-        running_task_count = 0
-        services_with_tasks = []
-        for svc in environment.ecs_services:
-            tasks = svc.get_running_task_arns()
-            if tasks:
-                running_task_count += len(tasks)
-                services_with_tasks.append('{} ({})'.format(svc.service_arn, len(tasks)))
+    sleeping_time = SHUTDOWN_INITIAL_CHECK_INTERVAL
+    remaining_services = list(services)
+    while True:
+        task_counts = environment.poll_running_task_counts(remaining_services)
+        remaining_services = [svc for svc, count in task_counts.items() if count]
+        running_task_count = sum(task_counts.values())
+        services_with_tasks = ['{} ({})'.format(svc.service_arn, task_counts[svc]) for svc in remaining_services]
 
+        elapsed = int(time.time() - start_time)
         if running_task_count == 0:
-            elapsed = int(time.time() - start_time)
-            print("{} environment fully shut down in {}s, 0 tasks running".format(environment.color.upper(), elapsed))
+            print("{} environment fully shut down in {}s, 0 tasks running".format(
+                environment.color.upper(), elapsed))
             return
+        if elapsed >= SHUTDOWN_TIMEOUT:
+            break
 
-        elapsed = int(time.time() - start_time)
         print("Waiting for {} shutdown: {} task(s) still running ({}s / {}s) - services: {}".format(
-            environment.color.upper(), running_task_count, elapsed, SHUTDOWN_TIMEOUT, ', '.join(services_with_tasks)))
-        time.sleep(SHUTDOWN_CHECK_INTERVAL)
+            environment.color.upper(), running_task_count, elapsed, SHUTDOWN_TIMEOUT,
+            ', '.join(services_with_tasks)))
+        yield min(sleeping_time, SHUTDOWN_TIMEOUT - elapsed)
+        sleeping_time = min(sleeping_time * SHUTDOWN_BACKOFF_FACTOR, SHUTDOWN_CHECK_INTERVAL)
 
     raise Exception(
         "\n\n"
@@ -81,28 +125,340 @@ def ensure_environment_is_shut_down(environment):
 
 
 # Démarre tous les services d'un environement et attend qu'il soit entièrement up
-def start_environment_and_wait_for_health(environment, verify_rollout=False):
+# Avec match_capacity_of, chaque service démarre avec le nombre de tâches de son équivalent dans cet environnement
+# (appariés par nom sans couleur), au lieu de DEFAULT_DESIRED_COUNT. La capacité min ainsi relevée est ramenée à la
+# valeur par défaut par release_matched_capacity, une fois la bascule faite.
+# Avec readiness=READINESS_TARGET_GROUP, l'attente porte sur les cibles des target groups (describe_target_health)
+# plutôt que sur les tâches de chaque service.
+# services limite le démarrage et l'attente à un sous-ensemble (cf. get_services_with_changed_image)
+@instrumentation.traced
+def start_environment_and_wait_for_health(environment, verify_rollout=False, match_capacity_of=None,
+                                          readiness=constant.READINESS_TASKS,
+                                          min_healthy_targets=constant.MINIMUM_HEALTHY_DESIRED_COUNT,
+                                          target_group_arns=None, services=None):
+    target_services = services if services is not None else environment.ecs_services
     if verify_rollout:
-        print("Rollout verification enabled for all {} services".format(len(environment.ecs_services)))
-        environment.enable_rollout_verification()
-    print("Starting all {} services in {} environment".format(len(environment.ecs_services), environment.color))
-    environment.start_up_services()
-    print("Waiting for all services to be healthy{}...".format(
-        " and rollout complete" if verify_rollout else ""))
-    environment.wait_for_services_health()
+        print("Rollout verification enabled for {} services".format(len(target_services)))
+        environment.enable_rollout_verification(services=target_services)
+    desired_counts = None
+    if match_capacity_of is not None:
+        desired_counts = environment.get_desired_counts_matching(match_capacity_of)
+        print("Matching capacity of {} environment: {}".format(match_capacity_of.color, ', '.join(
+            '{} ({})'.format(arn, count) for arn, count in desired_counts.items())))
+    print("Starting {} services in {} environment".format(len(target_services), environment.color))
+    with instrumentation.span('start_up_services'):
+        environment.start_up_services(desired_counts=desired_counts, services=target_services)
+    if readiness == constant.READINESS_TARGET_GROUP:
+        print("Waiting for {} environment target groups to have {} healthy target(s)...".format(
+            environment.color, min_healthy_targets))
+        with instrumentation.span('wait_for_target_group_health'):
+            environment.wait_for_target_group_health(min_healthy_targets, target_group_arns)
+        return
+    print("Waiting for {} services to be healthy{}...".format(
+        len(target_services), " and rollout complete" if verify_rollout else ""))
+    with instrumentation.span('wait_for_services_health'):
+        environment.wait_for_services_health(services=target_services)
+
+
+# Sélectionne les services dont l'image change : le digest des conteneurs de leurs tâches RUNNING (describe_tasks)
+# est comparé au digest de l'image du tag de déploiement (Repository.image). Un service sans tâche, ou dont une tâche
+# tourne sur un autre digest, est à redémarrer ; les autres gardent leurs tâches.
+@instrumentation.traced
+def get_services_with_changed_image(deployment_manager, environment):
+    running_services, stopped_services = _split_services_with_changed_image(deployment_manager, environment)
+    return [s for s in environment.ecs_services if s in running_services or s in stopped_services]
+
+
+# Services dont l'image change, séparés entre ceux qui ont encore des tâches et ceux qui n'en ont aucune
+def _split_services_with_changed_image(deployment_manager, environment):
+    digest_by_repository_name = {r.name: r.image['imageDigest'] for r in deployment_manager.repositories
+                                 if r.image.get('imageDigest')}
+    repository_names = ecs_manager.get_cluster_inventory(environment.cluster_name).get_repository_names(
+        [s.service_arn for s in environment.ecs_services])
+    containers_by_service_arn = environment.get_running_containers()
+
+    running_services = []
+    stopped_services = []
+    for svc in environment.ecs_services:
+        repository_name = repository_names.get(svc.service_arn)
+        running_digests = {c.get('imageDigest') for c in containers_by_service_arn.get(svc.service_arn, [])
+                           if common.get_repository_name_from_image(c.get('image', '')) == repository_name}
+        new_digest = digest_by_repository_name.get(repository_name)
+        if not running_digests:
+            stopped_services.append(svc)
+        elif new_digest is not None and running_digests != {new_digest}:
+            running_services.append(svc)
+    print("{} service(s) out of {} have a new image in {} environment ({} without running task): {}".format(
+        len(running_services) + len(stopped_services), len(environment.ecs_services), environment.color,
+        len(stopped_services), ', '.join(s.service_arn for s in running_services + stopped_services)))
+    return running_services, stopped_services
+
+
+# Redéploie les services dont l'image change, les autres gardent leurs tâches en cours
+# Seuls les repositories de ces services reçoivent le tag de la couleur. Un service qui a encore des tâches reçoit un
+# nouveau déploiement (forceNewDeployment) : ECS remplace ses tâches sans passer par 0. Un service arrêté (desiredCount
+# et MinCapacity à 0) est démarré par start_up_services, qui réactive son autoscaling.
+# La vérification du rollout est toujours active : sans elle, les anciennes tâches encore healthy suffiraient.
+@instrumentation.traced
+def deploy_changed_services(deployment_manager, environment, readiness=constant.READINESS_TASKS,
+                            min_healthy_targets=constant.MINIMUM_HEALTHY_DESIRED_COUNT, target_group_arns=None,
+                            max_workers=REDEPLOY_MAX_WORKERS):
+    running_services, stopped_services = _split_services_with_changed_image(deployment_manager, environment)
+    changed_services = [s for s in environment.ecs_services if s in running_services or s in stopped_services]
+    if not changed_services:
+        print("No service to redeploy in {} environment".format(environment.color))
+        return changed_services
+
+    repository_names = ecs_manager.get_cluster_inventory(environment.cluster_name).get_repository_names(
+        [s.service_arn for s in changed_services])
+    deployment_manager.add_tag_to_repositories(environment.color.upper(),
+                                               repositories_name=set(repository_names.values()))
+
+    environment.enable_rollout_verification(services=changed_services)
+    if running_services:
+        print("Redeploying {} service(s) in place in {} environment".format(
+            len(running_services), environment.color))
+        with instrumentation.TracedThreadPoolExecutor(
+                max_workers=min(max_workers, len(running_services))) as executor:
+            list(executor.map(lambda s: s.request_new_deployment(), running_services))
+    if stopped_services:
+        print("Starting {} stopped service(s) in {} environment".format(len(stopped_services), environment.color))
+        with instrumentation.span('start_up_services'):
+            environment.start_up_services(services=stopped_services, max_workers=max_workers)
+
+    print("Waiting for {} redeployed services to be healthy and rollout complete...".format(len(changed_services)))
+    with instrumentation.span('wait_for_services_health'):
+        environment.wait_for_services_health(services=changed_services)
+    if readiness == constant.READINESS_TARGET_GROUP:
+        print("Waiting for {} environment target groups to have {} healthy target(s)...".format(
+            environment.color, min_healthy_targets))
+        with instrumentation.span('wait_for_target_group_health'):
+            environment.wait_for_target_group_health(min_healthy_targets, target_group_arns)
+    return changed_services
+
+
+# Rend la main à l'autoscaling après un démarrage à capacité égale : la capacité min revient à la valeur par défaut
+# et le nombre de tâches redescend selon la politique de scaling du service
+@instrumentation.traced
+def release_matched_capacity(environment):
+    services = environment.restore_default_min_capacity()
+    print("Restored MinCapacity {} on {} service(s) of {} environment".format(
+        constant.DEFAULT_DESIRED_COUNT, len(services), environment.color))
+
+
+# Prépare l'environnement inactif avant la bascule : envoie des requêtes synthétiques par les hosts colorés
+# (ex: blue.beta.verde) jusqu'à ce que le p95 d'un tour passe sous la cible
+@instrumentation.traced
+def warm_up_environment(deployment_manager, environment, paths=WARM_UP_PATHS, p95_target=WARM_UP_P95_TARGET,
+                        timeout=WARM_UP_TIMEOUT, requests_per_round=WARM_UP_REQUESTS_PER_ROUND,
+                        base_urls=None, send_request=None):
+    """Warm up an environment and gate the switch on its latency.
+    Args:
+        base_urls: urls to warm up (defaults to the color-prefixed hosts of the listener)
+        send_request: callable(url) -> latency in seconds, replaces the default HTTP GET
+    Returns the p95 latency of the last round."""
+    if base_urls is None:
+        scheme = deployment_manager.http_listener['Protocol'].lower()
+        base_urls = ['{}://{}'.format(scheme, host) for host in
+                     alb_manager.get_colored_host_headers(deployment_manager.http_listener, environment.color)]
+    if not base_urls:
+        print("No color-prefixed host found for {} environment, skipping warm-up".format(environment.color))
+        return None
+
+    send_request = send_request or _send_warm_up_request
+    urls = [base_url.rstrip('/') + path for base_url in base_urls for path in paths]
+    round_urls = [urls[i % len(urls)] for i in range(max(requests_per_round, len(urls)))]
+    print("Warming up {} environment on {} url(s), target p95 {}s".format(environment.color, len(urls), p95_target))
+
+    start_time = time.time()
+    warm_up_round = 1
+    while True:
+        with instrumentation.TracedThreadPoolExecutor(
+                max_workers=min(WARM_UP_MAX_WORKERS, len(round_urls))) as executor:
+            latencies = sorted(executor.map(send_request, round_urls))
+        p95_latency = latencies[math.ceil(0.95 * len(latencies)) - 1]
+
+        elapsed = int(time.time() - start_time)
+        print("Warm-up round {} on {}: p95 {:.3f}s ({}s / {}s)".format(
+            warm_up_round, environment.color, p95_latency, elapsed, timeout))
+        if p95_latency <= p95_target:
+            return p95_latency
+        if elapsed >= timeout:
+            raise Exception("Warm-up of {} environment did not reach p95 {}s after {}s (last p95 {:.3f}s)".format(
+                environment.color, p95_target, timeout, p95_latency))
+        warm_up_round += 1
+
+
+def _send_warm_up_request(url):
+    """GET an url and return its latency. Errors still count: a slow failure is a cold service."""
+    start_time = time.time()
+    try:
+        with urllib.request.urlopen(url, timeout=WARM_UP_REQUEST_TIMEOUT) as response:
+            response.read()
+    except urllib.error.HTTPError:
+        pass
+    except Exception as err:
+        print("Warm-up request to {} failed: {}".format(url, err))
+        return WARM_UP_REQUEST_TIMEOUT
+    return time.time() - start_time
+
+
+# Déploie sur l'environnement inactif puis bascule le trafic, en recouvrant les attentes indépendantes
+# L'environnement inactif démarre et est vérifié pendant que les jobs smuggler de l'environnement actif se terminent.
+# L'ordre n'est imposé qu'aux points qui l'exigent : le retag après l'arrêt de l'environnement inactif, la bascule
+# après la santé du nouvel environnement et la fin des jobs de l'ancien.
+@instrumentation.traced
+def deploy_pipelined(deployment_manager, verify_rollout=False, match_capacity=False, warm_up=False,
+                     readiness=constant.READINESS_TASKS):
+    active_environment = deployment_manager.get_active_environment()
+    inactive_environment = deployment_manager.get_inactive_environment()
+    print("Pipelined deployment from {} to {}".format(active_environment.color, inactive_environment.color))
+
+    ensure_environment_is_shut_down(inactive_environment)
+    deployment_manager.add_tag_to_repositories(inactive_environment.color.upper())
+
+    stop_event = threading.Event()
+    with instrumentation.TracedThreadPoolExecutor(max_workers=2) as executor:
+        start_future = executor.submit(start_environment_and_wait_for_health, inactive_environment, verify_rollout,
+                                       active_environment if match_capacity else None, readiness)
+        drain_future = executor.submit(_wait_for_active_jobs_to_complete, active_environment, stop_event)
+        done, _ = wait([start_future, drain_future], return_when=FIRST_EXCEPTION)
+        if any(f.exception() for f in done):
+            stop_event.set()
+    # Le démarrage est attendu en premier : son échec est la cause la plus utile à remonter
+    start_future.result()
+    drain_future.result()
+
+    if warm_up:
+        warm_up_environment(deployment_manager, inactive_environment)
+    do_balancing(deployment_manager, active_environment, inactive_environment)
+    release_error = None
+    if match_capacity:
+        try:
+            release_matched_capacity(inactive_environment)
+        except Exception as err:
+            # Le trafic est déjà basculé : l'ancien environnement est arrêté quoi qu'il arrive, l'erreur est levée après
+            release_error = err
+    # Les jobs ont déjà été attendus : il ne reste que ceux lancés pendant le démarrage, vérification courte
+    ensure_environment_is_shut_down(active_environment)
+    if release_error is not None:
+        raise release_error
 
 
 # Passe d'un environnement à l'autre en modifiant les targets groups des règles du listener
+@instrumentation.traced
 def do_balancing(deployment_manager, from_environment, to_environment):
     print("Do balancing from environment {} to environment {}".format(from_environment.color, to_environment.color))
-    deployment_manager.update_rule_target_group(
+    # Toutes les modifications sont calculées avant le premier appel puis envoyées ensemble
+    plan = deployment_manager.build_switch_plan(
         expected_rule_type=from_environment.target_group_type,
         expected_rule_color=from_environment.color,
         new_target_group_arn=to_environment.target_group_arn
     )
+    print("Switch plan: {} rule(s) to move to {}".format(len(plan), to_environment.target_group_arn))
+    split_window = deployment_manager.apply_switch_plan(plan)
+    print("Balancing done, traffic was split between {} and {} for {:.3f}s".format(
+        from_environment.color, to_environment.color, split_window))
+    return split_window
+
+
+# Passe progressivement d'un environnement à l'autre en pondérant les target groups des règles du listener
+# A chaque étape le trafic est maintenu le temps de vérifier la santé des cibles et les métriques du nouvel
+# environnement. En cas de dépassement d'un seuil, tout le trafic revient sur l'environnement de départ.
+@instrumentation.traced
+def do_progressive_balancing(deployment_manager, from_environment, to_environment, steps=CANARY_STEPS,
+                             hold_time=CANARY_HOLD_TIME, max_p95_latency=CANARY_MAX_P95_LATENCY,
+                             max_5xx_rate=CANARY_MAX_5XX_RATE,
+                             min_healthy_targets=constant.MINIMUM_HEALTHY_DESIRED_COUNT):
+    # Validé avant toute modification : des étapes qui n'atteignent pas 100 laisseraient le trafic partagé
+    steps = list(steps)
+    if not steps or steps[-1] != 100 or any(w <= 0 for w in steps) \
+            or any(a >= b for a, b in zip(steps, steps[1:])):
+        raise Exception("Invalid progressive balancing steps {}: expected increasing percentages ending at 100"
+                        .format(steps))
+    print("Do progressive balancing from environment {} to environment {} with steps {}".format(
+        from_environment.color, to_environment.color, steps))
+    # Les règles sont figées au départ : pendant la bascule elles pointent vers les deux couleurs
+    rules = deployment_manager.get_rules_with_type_and_color(from_environment.target_group_type,
+                                                            from_environment.color)
+
+    weight = 0
+    try:
+        for weight in steps:
+            if weight == 100:
+                deployment_manager.update_rules_target_group(rules, to_environment.target_group_arn)
+                print("Progressive balancing done, 100% of traffic on {}".format(to_environment.color))
+                return
 
+            print("Shift {}% of traffic to {}".format(weight, to_environment.color))
+            deployment_manager.update_rules_weights(rules, {
+                from_environment.target_group_arn: 100 - weight,
+                to_environment.target_group_arn: weight,
+            })
 
-def deploy_services_of_repositories_name(environment, repositories_name, verify_rollout=False):
+            breach = _hold_and_check_canary(deployment_manager, to_environment, hold_time, max_p95_latency,
+                                            max_5xx_rate, min_healthy_targets)
+            if breach:
+                raise Exception("Progressive balancing rolled back at {}% of traffic on {}: {}".format(
+                    weight, to_environment.color, breach))
+    except Exception as err:
+        # Quelle que soit l'erreur (seuil dépassé, appel AWS, métriques), tout le trafic revient sur l'origine
+        print("Progressive balancing failed at {}%: {}. Rolling back to {}".format(
+            weight, err, from_environment.color))
+        deployment_manager.update_rules_target_group(rules, from_environment.target_group_arn)
+        raise
+
+
+def _hold_and_check_canary(deployment_manager, environment, hold_time, max_p95_latency, max_5xx_rate,
+                           min_healthy_targets):
+    """Hold the current traffic split, checking target health and CloudWatch metrics.
+    Returns a description of the first breached threshold, None if every check passed."""
+    start_time = time.time()
+    while True:
+        health = alb_manager.get_target_health_counts(environment.target_group_arn)
+        if health.get('healthy', 0) < min_healthy_targets:
+            return "{} healthy target(s), {} required ({})".format(
+                health.get('healthy', 0), min_healthy_targets, health)
+
+        metrics = cloudwatch_manager.get_target_group_metrics(
+            deployment_manager.alb['LoadBalancerArn'], environment.target_group_arn)
+        p95_latency = metrics.get('p95_latency')
+        if p95_latency is not None and p95_latency > max_p95_latency:
+            return "p95 latency {:.3f}s above {}s".format(p95_latency, max_p95_latency)
+        if metrics.get('requests'):
+            error_rate = metrics.get('http_5xx', 0) / metrics['requests']
+            if error_rate > max_5xx_rate:
+                return "5xx rate {:.2%} above {:.2%}".format(error_rate, max_5xx_rate)
+
+        elapsed = int(time.time() - start_time)
+        print("Canary healthy on {}: targets {}, metrics {} ({}s / {}s)".format(
+            environment.color, health, metrics, elapsed, hold_time))
+        if elapsed >= hold_time:
+            return None
+        time.sleep(min(CANARY_CHECK_INTERVAL, hold_time - elapsed))
+
+
+def _start_services(services, max_workers):
+    """Start services with bounded concurrency. A failing service does not abort the others:
+    failures are returned as a dict EcsService -> exception."""
+    failures = {}
+
+    def start(service):
+        print("Start service {}".format(service.resource_id))
+        try:
+            service.start()
+        except Exception as err:
+            print("Failed to start service {}: {}".format(service.resource_id, err))
+            failures[service] = err
+
+    with instrumentation.TracedThreadPoolExecutor(max_workers=max(1, min(max_workers, len(services)))) as executor:
+        list(executor.map(start, services))
+    return failures
+
+
+@instrumentation.traced
+def deploy_services_of_repositories_name(environment, repositories_name, verify_rollout=False,
+                                         max_workers=REDEPLOY_MAX_WORKERS):
     print("Deploy services for repositories: {}".format(repositories_name))
 
     repo_name_service_map = ecs_manager.get_map_of_repo_name_service(environment.color, environment.cluster_name)
@@ -126,14 +482,27 @@ def deploy_services_of_repositories_name(environment, repositories_name, verify_
         environment.enable_rollout_verification(services=services_to_start)
 
     if services_to_start:
-        for service in services_to_start:
-            print("Start service {}".format(service.resource_id))
-            service.start()
+        print("Starting {} services with at most {} in parallel".format(len(services_to_start), max_workers))
+        failures = _start_services(services_to_start, max_workers)
+        started_services = [s for s in services_to_start if s not in failures]
+
+        errors = []
+        if failures:
+            errors.append("Unable to start {} service(s): {}".format(
+                len(failures), ', '.join('{} ({})'.format(s.service_arn, err) for s, err in failures.items())))
+        if started_services:
+            # Wait only for the deployed services to be healthy (not all services in the environment)
+            time.sleep(10)
+            print("Waiting for {} redeployed services to be healthy{}...".format(
+                len(started_services), " and rollout complete" if verify_rollout else ""))
+            try:
+                with instrumentation.span('wait_for_services_health'):
+                    environment.wait_for_services_health(services=started_services)
+            except Exception as err:
+                # Les échecs de démarrage ne doivent pas être masqués par ceux de la vérification de santé
+                errors.append(str(err))
 
-        # Wait only for the deployed services to be healthy (not all services in the environment)
-        time.sleep(10)
-        print("Waiting for {} redeployed services to be healthy{}...".format(
-            len(services_to_start), " and rollout complete" if verify_rollout else ""))
-        environment.wait_for_services_health(services=services_to_start)
+        if errors:
+            raise Exception('. '.join(errors))
     else:
         print("No matching services found to redeploy")
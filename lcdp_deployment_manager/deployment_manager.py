@@ -1,12 +1,17 @@
+import heapq
+import re
 import time
-from concurrent.futures import ThreadPoolExecutor
 
 from . import common as common
 from . import constant as constant
+from . import instrumentation as instrumentation
 from . import manage_alb as alb_manager
 from . import manage_cloudwatch as cloudwatch_manager
 from . import manage_ecr as ecr_manager
 
+# Segment de couleur d'un nom de service, seulement en début ou en fin de nom
+UNCOLORED_NAME_PATTERN = re.compile('^-?({0}|{1})-?|-?({0}|{1})-?$'.format(constant.BLUE, constant.GREEN))
+
 
 ###
 #   Classe permettant de gérer le déployement
@@ -20,6 +25,8 @@ class DeploymentManager:
     active_color = None
     blue_environment = {}
     green_environment = {}
+    # Cache arn -> tags des target groups (et du listener)
+    resource_tags = {}
 
     # Clients
     elbv2_client = None
@@ -27,7 +34,8 @@ class DeploymentManager:
     def __init__(self, elbv2_client, alb, http_listener, rules, repositories,
                  active_color, current_target_group_type,
                  blue_environment,
-                 green_environment):
+                 green_environment,
+                 resource_tags=None):
         self.elbv2_client = elbv2_client
         self.alb = alb
         self.http_listener = http_listener
@@ -37,22 +45,110 @@ class DeploymentManager:
         self.current_target_group_type = current_target_group_type
         self.blue_environment = blue_environment
         self.green_environment = green_environment
+        self.resource_tags = resource_tags if resource_tags is not None else {}
+        self.__index_rules()
+
+    # Construit l'index des règles : priorités libres (tas), règles par scope et par (type, couleur)
+    # L'index est ensuite tenu à jour par create_rule et apply_switch_plan, sans nouveau describe
+    def __index_rules(self):
+        self.__used_priorities = set()
+        self.__rules_by_scope = {}
+        # (type, couleur) -> règles, construit au premier besoin car il nécessite les tags des target groups
+        self.__rules_by_type_and_color = None
+        self.__type_and_color_by_rule_arn = {}
+        for rule in self.rules:
+            self.__index_rule(rule)
+        self.__next_priority = max(self.__used_priorities, default=0) + 1
+        self.__free_priorities = [p for p in range(1, self.__next_priority) if p not in self.__used_priorities]
+        heapq.heapify(self.__free_priorities)
+
+    def __index_rule(self, rule):
+        if not rule['IsDefault']:
+            self.__used_priorities.add(int(rule['Priority']))
+        scope = self.__get_rule_tag(rule, constant.TARGET_GROUP_SCOPE_TAG_NAME)
+        if scope:
+            self.__rules_by_scope.setdefault(scope, []).append(rule)
+        if self.__rules_by_type_and_color is not None:
+            self.__index_rule_type_and_color(rule)
+
+    def __index_rule_type_and_color(self, rule):
+        keys = set()
+        for target_group_arn in self.__get_forward_target_group_arns(rule['Actions'], routed_only=True):
+            tags = self.__get_resource_tags(target_group_arn)
+            keys.add((common.get_type_tag(tags), common.get_color_tag(tags)))
+        for key in keys:
+            self.__rules_by_type_and_color.setdefault(key, []).append(rule)
+        self.__type_and_color_by_rule_arn[rule['RuleArn']] = keys
+
+    def __unindex_rule_type_and_color(self, rule):
+        for key in self.__type_and_color_by_rule_arn.pop(rule['RuleArn'], set()):
+            self.__rules_by_type_and_color[key].remove(rule)
+
+    def __get_rule_tag(self, rule, tag_name):
+        for tag in rule.get('Tags', []):
+            if tag['Key'] == tag_name:
+                return tag['Value']
+        return None
 
-    # Constuit une action pour le listener
-    def __build_forward_actions(self, target_group_arn):
+    # Constuit une action pour le listener, pondérée entre un ou plusieurs target groups (arn -> poids)
+    def __build_forward_actions(self, weights):
         return {
             "Type": "forward",
-            "TargetGroupArn": target_group_arn,
+            "ForwardConfig": {
+                "TargetGroups": [{"TargetGroupArn": arn, "Weight": weight} for arn, weight in weights.items()]
+            },
             "Order": 1
         }
 
     def get_type(self, rule):
         if rule['IsDefault']:
-            return alb_manager.get_type_from_resource(self.http_listener['ListenerArn'])
-        for tag in rule.get('Tags', []):
-            if tag['Key'] == constant.TARGET_GROUP_TYPE_TAG_NAME:
-                return tag['Value']
-        return None
+            return alb_manager.get_type_from_resource(self.http_listener['ListenerArn'], self.resource_tags)
+        return self.__get_rule_tag(rule, constant.TARGET_GROUP_TYPE_TAG_NAME)
+
+    def get_active_color(self):
+        """Retourne la couleur recevant le trafic d'après le listener, en utilisant le cache de tags."""
+        return alb_manager.get_active_color(self.http_listener, self.resource_tags)
+
+    def get_active_type(self):
+        """Retourne le type recevant le trafic d'après le listener, en utilisant le cache de tags."""
+        return alb_manager.get_active_type(self.http_listener, self.resource_tags)
+
+    def invalidate_resource_tags(self):
+        self.resource_tags.clear()
+
+    # Récupère les tags d'un target group, en chargeant d'un coup tous ceux référencés par le listener
+    def __get_resource_tags(self, resource_arn):
+        if resource_arn not in self.resource_tags:
+            alb_manager.get_tags_for_resources(self.__get_referenced_target_group_arns() + [resource_arn],
+                                               self.resource_tags)
+        return self.resource_tags[resource_arn]
+
+    def __get_referenced_target_group_arns(self):
+        actions = list(self.http_listener['DefaultActions'])
+        for rule in self.rules:
+            actions.extend(rule['Actions'])
+        return self.__get_forward_target_group_arns(actions)
+
+    # routed_only : ne garde que les target groups recevant du trafic (poids > 0)
+    def __get_forward_target_group_arns(self, actions, routed_only=False):
+        arns = []
+        for action in actions:
+            if action['Type'] == 'forward':
+                weights = common.get_forward_target_group_weights(action)
+                arns.extend(arn for arn, weight in weights.items() if weight > 0 or not routed_only)
+        return arns
+
+    # Répartition du trafic d'une règle, normalisée pour comparer des poids exprimés différemment
+    def __get_traffic_distribution(self, actions):
+        weights = {}
+        for action in actions:
+            if action['Type'] == 'forward':
+                weights.update(common.get_forward_target_group_weights(action))
+        return self.__normalize_weights(weights)
+
+    def __normalize_weights(self, weights):
+        total = sum(weights.values())
+        return {arn: weight / total for arn, weight in weights.items() if weight > 0} if total else {}
 
     def get_active_environment(self):
         """Retourne l'environnement qui recoit actuellement le trafic."""
@@ -71,37 +167,132 @@ class DeploymentManager:
         raise Exception('Unable to get inactive environment...')
 
     def create_rule(self, conditions, actions, priority, tags):
-        self.elbv2_client.create_rule(
+        response = self.elbv2_client.create_rule(
             ListenerArn=self.http_listener['ListenerArn'],
             Conditions=conditions,
             Actions=actions,
             Priority=priority,
             Tags=tags
         )
+        rule = response['Rules'][0]
+        rule['Tags'] = tags
+        self.__used_priorities.add(int(rule['Priority']))
+        # Comme get_uncolored_rules : une règle colorée n'est ni dans self.rules ni dans l'index
+        if alb_manager.is_uncolored_rule(rule):
+            self.rules.append(rule)
+            self.__index_rule(rule)
+        return rule
 
     def update_rule_target_group(self, expected_rule_type, expected_rule_color, new_target_group_arn):
-        targeted_rules = self.get_rules_with_type_and_color(expected_rule_type, expected_rule_color)
-        for targeted_rule in targeted_rules:
-            self.__modify_rule_target_group(targeted_rule, new_target_group_arn)
+        plan = self.build_switch_plan(expected_rule_type, expected_rule_color, new_target_group_arn)
+        return self.apply_switch_plan(plan)
 
     def update_rules_target_group(self, rules, new_target_group_arn):
-        for rule in rules:
-            self.__modify_rule_target_group(rule, new_target_group_arn)
-
-    def __modify_rule_target_group(self, rule, target_group_arn):
-        if rule['IsDefault']:
+        return self.apply_switch_plan(self.build_weighted_switch_plan(rules, {new_target_group_arn: 1}))
+
+    def update_rules_weights(self, rules, weights):
+        """Forward rules to several target groups with the given weights (target group arn -> weight)."""
+        return self.apply_switch_plan(self.build_weighted_switch_plan(rules, weights))
+
+    def build_switch_plan(self, expected_rule_type, expected_rule_color, new_target_group_arn):
+        """Compute up front every rule and default action change needed to send the traffic of the
+        (type, color) rules to a new target group. Rules already forwarding there are left out."""
+        rules = self.get_rules_with_type_and_color(expected_rule_type, expected_rule_color)
+        return self.build_weighted_switch_plan(rules, {new_target_group_arn: 1})
+
+    def build_weighted_switch_plan(self, rules, weights):
+        """Compute the changes needed to forward rules with the given weights (target group arn -> weight)."""
+        actions = [self.__build_forward_actions(weights)]
+        expected_distribution = self.__normalize_weights(weights)
+        return [{'rule': rule, 'actions': actions} for rule in rules
+                if self.__get_traffic_distribution(rule['Actions']) != expected_distribution]
+
+    def apply_switch_plan(self, plan, max_workers=constant.SWITCH_MAX_WORKERS):
+        """Send every change of a switch plan concurrently. ELBv2 has no bulk API, so one modify_rule per
+        rule (modify_listener for the default action) is the minimum; sending them together keeps the window
+        where the listener is split between both colors as short as possible.
+        Failed changes are sent again; if some still fail, the applied ones are reverted to their previous
+        actions so the listener is not left half switched, then an exception is raised.
+        Returns the duration of that window in seconds."""
+        if not plan:
+            print('Switch plan is empty, listener already up to date')
+            return 0.0
+
+        start_time = time.time()
+        failures = self.__send_switch_changes(plan, max_workers)
+        attempt = 1
+        while failures and attempt < constant.SWITCH_MAX_ATTEMPTS:
+            attempt += 1
+            print('Retrying {} failed rule change(s), attempt {}/{}'.format(
+                len(failures), attempt, constant.SWITCH_MAX_ATTEMPTS))
+            failures = self.__send_switch_changes([change for change, _ in failures], max_workers)
+        split_window = time.time() - start_time
+
+        failed_changes = [change for change, _ in failures]
+        applied_changes = [change for change in plan if not any(change is failed for failed in failed_changes)]
+        if failures:
+            message = 'Unable to switch {} rule(s): {}'.format(len(failures), self.__describe_failures(failures))
+            # Les règles déjà modifiées reprennent leurs actions précédentes (l'état local n'a pas encore changé)
+            revert_plan = [{'rule': change['rule'], 'actions': change['rule']['Actions'], 'applied': change}
+                           for change in applied_changes]
+            revert_failures = self.__send_switch_changes(revert_plan, max_workers) if revert_plan else []
+            print('Reverted {} of {} applied rule change(s)'.format(
+                len(revert_plan) - len(revert_failures), len(revert_plan)))
+            if revert_failures:
+                # Ces règles restent sur leur nouvelle cible : l'état local en tient compte
+                for change, _ in revert_failures:
+                    self.__update_rule_actions(change['rule'], change['applied']['actions'])
+                message += '. Unable to revert {} rule(s): {}'.format(
+                    len(revert_failures), self.__describe_failures(revert_failures))
+            raise Exception(message)
+
+        # L'état local n'est mis à jour qu'une fois les appels terminés, hors des threads
+        for change in applied_changes:
+            self.__update_rule_actions(change['rule'], change['actions'])
+        print('Switched {} rule(s) in {:.3f}s, traffic was split between target groups during that window'
+              .format(len(plan), split_window))
+        return split_window
+
+    # Envoie des changements en parallèle, retourne ceux en échec avec leur exception
+    def __send_switch_changes(self, changes, max_workers):
+        with instrumentation.TracedThreadPoolExecutor(max_workers=min(max_workers, len(changes))) as executor:
+            futures = [(change, executor.submit(self.__send_rule_actions, change)) for change in changes]
+        return [(change, future.exception()) for change, future in futures if future.exception()]
+
+    @staticmethod
+    def __describe_failures(failures):
+        return ', '.join('{} ({})'.format(change['rule']['RuleArn'], err) for change, err in failures)
+
+    def __send_rule_actions(self, change):
+        if change['rule']['IsDefault']:
             return self.elbv2_client.modify_listener(
                 ListenerArn=self.http_listener['ListenerArn'],
-                DefaultActions=[self.__build_forward_actions(target_group_arn)]
-            )
-        else:
-            return self.elbv2_client.modify_rule(
-                RuleArn=rule['RuleArn'],
-                Actions=[self.__build_forward_actions(target_group_arn)]
+                DefaultActions=change['actions']
             )
+        return self.elbv2_client.modify_rule(
+            RuleArn=change['rule']['RuleArn'],
+            Actions=change['actions']
+        )
+
+    # Met à jour les actions d'une règle connue et sa place dans l'index (type, couleur)
+    def __update_rule_actions(self, rule, actions):
+        if rule['IsDefault']:
+            self.http_listener['DefaultActions'] = actions
+        if self.__rules_by_type_and_color is not None:
+            self.__unindex_rule_type_and_color(rule)
+        rule['Actions'] = actions
+        if self.__rules_by_type_and_color is not None:
+            self.__index_rule_type_and_color(rule)
 
     def get_rules_with_type_and_color(self, expected_type, expected_color):
-        return [r for r in self.rules if self.__assert_rule(r, expected_type, expected_color)]
+        if self.__rules_by_type_and_color is None:
+            self.__rules_by_type_and_color = {}
+            for rule in self.rules:
+                self.__index_rule_type_and_color(rule)
+        return list(self.__rules_by_type_and_color.get((expected_type, expected_color), []))
+
+    def get_rules_with_scope(self, scope):
+        return list(self.__rules_by_scope.get(scope, []))
 
     def get_forward_rules(self):
         return self.get_typed_rules('forward')
@@ -117,26 +308,20 @@ class DeploymentManager:
                     typed_rules.append(rule)
         return typed_rules
 
-    def __assert_rule(self, rule, expected_type, expected_color):
-        expected = (expected_type, expected_color)
-
-        for action in rule['Actions']:
-            if action['Type'] == 'forward':
-                tap_tpl = common.get_type_and_color_for_resource(action['TargetGroupArn'], self.elbv2_client)
-                if tap_tpl == expected:
-                    return True
-
-        return False
-
     def __assert_target_group(self, target_group, expected_type, expected_color):
 
         return target_group['Type'].upper() == expected_type.upper() \
             and target_group['Color'].upper() == expected_color.upper()
 
-    # Ajout d'un tag a tous les repository d'un environement
-    def add_tag_to_repositories(self, tag):
-        for r in self.repositories:
-            r.add_tag(tag)
+    # Ajout d'un ou plusieurs tags a tous les repository d'un environement (ou à ceux de repositories_name)
+    # Les manifests sont résolus en parallèle, un seul batch_get_image par repository
+    def add_tag_to_repositories(self, tags, max_workers=constant.BUILD_MAX_WORKERS, repositories_name=None):
+        tags = [tags] if isinstance(tags, str) else list(tags)
+        repositories = [r for r in self.repositories if repositories_name is None or r.name in repositories_name]
+        if not repositories:
+            return
+        with instrumentation.TracedThreadPoolExecutor(max_workers=min(max_workers, len(repositories))) as executor:
+            list(executor.map(lambda r: r.add_tags(tags), repositories))
 
     def set_color_to_list_repositories_name(self, repositories_name):
         print('Add color {} to mismatched repositories: {}'.format(self.active_color, repositories_name))
@@ -153,16 +338,16 @@ class DeploymentManager:
             self.active_color)
 
     def get_lowest_available_priority_alb_rule(self):
-        used_priorities = set()
+        # Les priorités occupées depuis la construction de l'index sont retirées du tas au fil de l'eau
+        while self.__free_priorities and self.__free_priorities[0] in self.__used_priorities:
+            heapq.heappop(self.__free_priorities)
+        if self.__free_priorities:
+            return self.__free_priorities[0]
 
-        for rule in self.rules:
-            if not rule['IsDefault']:
-                used_priorities.add(int(rule['Priority']))
-
-        # Trouver la plus petite priorité disponible
-        for priority in range(1, 50001):  # Les priorités ALB vont de 1 à 50000
-            if priority not in used_priorities:
-                return priority
+        while self.__next_priority in self.__used_priorities:
+            self.__next_priority += 1
+        if self.__next_priority <= constant.ALB_MAX_RULE_PRIORITY:
+            return self.__next_priority
 
         # Si toutes les priorités sont utilisées (cas très improbable)
         return None
@@ -200,20 +385,95 @@ class Environment:
             svc.verify_rollout_complete = True
             print('Rollout verification enabled for {}'.format(svc.service_arn))
 
-    # Démarre tous les services en parallèle
-    def start_up_services(self, desired_count=None):
-        with ThreadPoolExecutor(max_workers=len(self.ecs_services)) as executor:
-            list(executor.map(lambda s: s.start(desired_count), self.ecs_services))
+    # Démarre tous les services (ou un sous-ensemble)
+    # Tous les update_service sont envoyés d'abord, puis la stabilité est suivie pour l'ensemble des services avec un
+    # describe_services par lot de 10 ; l'autoscaling de chaque service est réactivé dès qu'il est stable.
+    # desired_counts (arn de service -> nombre de tâches) remplace desired_count pour les services concernés
+    def start_up_services(self, desired_count=None, desired_counts=None, services=None,
+                          max_workers=constant.ECS_START_MAX_WORKERS):
+        target_services = services if services is not None else self.ecs_services
+        if not target_services:
+            return
+        with instrumentation.TracedThreadPoolExecutor(max_workers=min(max_workers, len(target_services))) as executor:
+            list(executor.map(lambda s: s.request_new_deployment(), target_services))
+
+        with instrumentation.span('services_stable_watch', services=len(target_services)):
+            common.run_poller(self.iter_services_stable_checks(target_services, desired_count, desired_counts))
         # Wait for all service receive startup
         time.sleep(10)
 
-    # Eteint tous les services
-    def shutdown_services(self):
-        with ThreadPoolExecutor(max_workers=len(self.ecs_services)) as executor:
-            list(executor.map(lambda s: s.shutdown(), self.ecs_services))
+    # Poller de stabilité (cf. common.run_poller) : un describe_services par lot de 10 à chaque tour,
+    # l'autoscaling de chaque service est réactivé dès qu'il est stable
+    def iter_services_stable_checks(self, services, desired_count=None, desired_counts=None):
+        desired_counts = desired_counts or {}
+        pending = list(services)
+        attempt = 1
+        while True:
+            descriptions = common.describe_services(self.ecs_client, self.cluster_name,
+                                                    [s.service_arn for s in pending])
+            stable = [s for s in pending if s.is_stable(descriptions.get(s.service_arn))]
+            for svc in stable:
+                svc.enable_autoscaling(desired_counts.get(svc.service_arn, desired_count))
+            pending = [s for s in pending if s not in stable]
+            if not pending:
+                return
+            if attempt >= constant.SERVICES_STABLE_MAX_ATTEMPTS:
+                raise Exception("Unable to start, services not stable after {}s: {}".format(
+                    attempt * constant.SERVICES_STABLE_DELAY, ', '.join(s.service_arn for s in pending)))
+            print('Waiting for deployment of {}/{} services to stabilize...'.format(len(pending), len(services)))
+            yield constant.SERVICES_STABLE_DELAY
+            attempt += 1
+
+    # Eteint tous les services (ou un sous-ensemble)
+    def shutdown_services(self, services=None):
+        target_services = services if services is not None else self.ecs_services
+        if not target_services:
+            return
+        with instrumentation.TracedThreadPoolExecutor(max_workers=len(target_services)) as executor:
+            list(executor.map(lambda s: s.shutdown(), target_services))
         # Wait for all service receive shutdown
         time.sleep(10)
 
+    # Nombre de tâches actuel de chaque service (le plus grand de runningCount et desiredCount),
+    # indexé par nom de service sans couleur pour l'apparier avec son équivalent de l'autre environnement
+    def get_services_task_count_by_uncolored_name(self):
+        descriptions = common.describe_services(self.ecs_client, self.cluster_name,
+                                                [s.service_arn for s in self.ecs_services])
+        task_counts = {}
+        for svc in self.ecs_services:
+            description = descriptions.get(svc.service_arn, {})
+            task_counts[svc.get_uncolored_name()] = max(description.get('runningCount', 0),
+                                                        description.get('desiredCount', 0))
+        return task_counts
+
+    # Calcule le nombre de tâches de démarrage de chaque service pour égaler la capacité d'un autre environnement
+    # Le résultat est borné par DEFAULT_DESIRED_COUNT en bas et par la capacité max du service en haut
+    def get_desired_counts_matching(self, environment):
+        task_counts = environment.get_services_task_count_by_uncolored_name()
+        desired_counts = {}
+        for svc in self.ecs_services:
+            task_count = task_counts.get(svc.get_uncolored_name())
+            if task_count:
+                desired_counts[svc.service_arn] = min(max(task_count, constant.DEFAULT_DESIRED_COUNT),
+                                                      svc.max_capacity)
+        return desired_counts
+
+    # Ramène la capacité min des services démarrés au-dessus de la valeur par défaut
+    # L'autoscaling réduit ensuite le nombre de tâches au rythme de sa propre politique
+    def restore_default_min_capacity(self):
+        services = [s for s in self.ecs_services
+                    if s.min_capacity and s.min_capacity > constant.DEFAULT_DESIRED_COUNT]
+        failures = []
+        for svc in services:
+            try:
+                svc.set_min_capacity(constant.DEFAULT_DESIRED_COUNT)
+            except Exception as err:
+                failures.append('{} ({})'.format(svc.service_arn, err))
+        if failures:
+            raise Exception('Unable to restore MinCapacity {} on {} service(s): {}'.format(
+                constant.DEFAULT_DESIRED_COUNT, len(failures), ', '.join(failures)))
+        return services
+
     def get_unhealthy_services(self):
         return list(filter(lambda s: not s.is_service_healthy(), self.ecs_services))
 
@@ -224,24 +484,135 @@ class Environment:
     def all_services_have_at_least_one_healthy_instance(self):
         return all(s.has_at_least_one_healthy_instance() for s in self.ecs_services)
 
+    # Compte les cibles des target groups de l'environnement par état, un describe_target_health par target group
+    def get_target_health_counts(self, target_group_arns=None):
+        counts = {}
+        for target_group_arn in target_group_arns or [self.target_group_arn]:
+            for state, count in alb_manager.get_target_health_counts(target_group_arn).items():
+                counts[state] = counts.get(state, 0) + count
+        return counts
+
+    # Attend que les target groups de l'environnement soient prêts : au moins min_healthy_targets cibles healthy et
+    # plus aucune cible en cours d'enregistrement (initial). C'est ce vers quoi le load balancer routera après la bascule.
+    def wait_for_target_group_health(self, min_healthy_targets=constant.MINIMUM_HEALTHY_DESIRED_COUNT,
+                                     target_group_arns=None):
+        return common.run_poller(self.iter_target_group_health_checks(min_healthy_targets, target_group_arns))
+
+    # Poller de wait_for_target_group_health (cf. common.run_poller), retourne les compteurs du dernier tour
+    def iter_target_group_health_checks(self, min_healthy_targets=constant.MINIMUM_HEALTHY_DESIRED_COUNT,
+                                        target_group_arns=None):
+        start_time = time.time()
+        sleeping_time = constant.HEALTHCHECK_INITIAL_SLEEPING_TIME
+        retry = 1
+        while True:
+            counts = self.get_target_health_counts(target_group_arns)
+            healthy, initial = counts.get('healthy', 0), counts.get('initial', 0)
+            elapsed = int(time.time() - start_time)
+            if healthy >= min_healthy_targets and initial == 0:
+                print("Tried {} times and {} environment target groups are ready: {} healthy, {} draining ({}s)"
+                      .format(retry, self.color, healthy, counts.get('draining', 0), elapsed))
+                return counts
+            if elapsed >= constant.HEALTHCHECK_TIMEOUT:
+                break
+            print("Retry number {}: {} healthy target(s) ({} required), {} initial, {} draining, sleeping {} seconds "
+                  "before retry ({}s / {}s)".format(retry, healthy, min_healthy_targets, initial,
+                                                    counts.get('draining', 0), sleeping_time, elapsed,
+                                                    constant.HEALTHCHECK_TIMEOUT))
+            yield min(sleeping_time, constant.HEALTHCHECK_TIMEOUT - elapsed)
+            sleeping_time = min(sleeping_time * constant.HEALTHCHECK_BACKOFF_FACTOR, constant.HEALTHCHECK_SLEEPING_TIME)
+            retry = retry + 1
+
+        raise Exception("Unable to deploy, target groups of {} environment not ready: {}".format(self.color, counts))
+
     # Attend que tous les services (ou un sous-ensemble) soient healthy
+    # Un seul poller pour tout l'environnement, avec un intervalle croissant entre deux vérifications
     def wait_for_services_health(self, services=None):
+        common.run_poller(self.iter_services_health_checks(services))
+
+    # Poller de santé (cf. common.run_poller) : un tour de poll_services_health à chaque itération, à intervalle
+    # croissant, jusqu'à ce que tous les services soient healthy ou que HEALTHCHECK_TIMEOUT soit atteint
+    def iter_services_health_checks(self, services=None):
         target_services = services if services is not None else self.ecs_services
+        unhealthy = list(target_services)
+        start_time = time.time()
+        sleeping_time = constant.HEALTHCHECK_INITIAL_SLEEPING_TIME
         retry = 1
-        print("Waiting {} seconds before first try".format(constant.HEALTHCHECK_SLEEPING_TIME))
-        time.sleep(constant.HEALTHCHECK_SLEEPING_TIME)
-        while not all(s.has_at_least_one_healthy_instance() for s in target_services) and constant.HEALTHCHECK_RETRY_LIMIT >= retry:
-            print("Retry number {} all services hasnt healthy sleeping {} seconds before retry"
-                  .format(retry, constant.HEALTHCHECK_SLEEPING_TIME))
+        while True:
+            unhealthy = self.poll_services_health(unhealthy)
+            elapsed = int(time.time() - start_time)
+            if not unhealthy:
+                print("Tried {} times and all services are now healthy ({}s)".format(retry, elapsed))
+                return
+            if elapsed >= constant.HEALTHCHECK_TIMEOUT:
+                break
+            print("Retry number {}: {}/{} services healthy, sleeping {} seconds before retry ({}s / {}s)"
+                  .format(retry, len(target_services) - len(unhealthy), len(target_services), sleeping_time,
+                          elapsed, constant.HEALTHCHECK_TIMEOUT))
+            yield min(sleeping_time, constant.HEALTHCHECK_TIMEOUT - elapsed)
+            sleeping_time = min(sleeping_time * constant.HEALTHCHECK_BACKOFF_FACTOR, constant.HEALTHCHECK_SLEEPING_TIME)
             retry = retry + 1
-            time.sleep(constant.HEALTHCHECK_SLEEPING_TIME)
-        if constant.HEALTHCHECK_RETRY_LIMIT < retry:
-            print("Tried {} but retry limit has been reach before all services been healthy".format(retry))
-            unhealthy = [s for s in target_services if not s.has_at_least_one_healthy_instance()]
-            unhealthy_sve = ",".join(list(map(lambda a: a.service_arn, unhealthy)))
-            raise Exception("Unable to deploy, services still unhealthy. Unhealthy Services : {}".format(unhealthy_sve))
-        else:
-            print("Tried {} and all service are now healthy".format(retry))
+
+        print("Tried {} but timeout has been reach before all services been healthy".format(retry))
+        unhealthy_sve = ",".join(list(map(lambda a: a.service_arn, unhealthy)))
+        raise Exception("Unable to deploy, services still unhealthy. Unhealthy Services : {}".format(unhealthy_sve))
+
+    # Vérifie en un seul passage la santé d'une liste de services et retourne ceux qui ne sont pas encore healthy
+    # Un appel correspond à un tour de iter_services_health_checks
+    # Un seul describe_services par lot de 10 donne runningCount, les déploiements et leur rolloutState : les services
+    # écartés par cette vue (pas assez de tâches, rollout en cours ou en échec) ne coûtent aucun autre appel.
+    # list_tasks puis describe_tasks (par lot de 100) ne sont faits que pour les autres.
+    def poll_services_health(self, services):
+        descriptions = common.describe_services(self.ecs_client, self.cluster_name,
+                                                [s.service_arn for s in services])
+        candidates = [s for s in services
+                      if s.evaluate_service_description(descriptions.get(s.service_arn, {}),
+                                                        constant.MINIMUM_HEALTHY_DESIRED_COUNT)]
+        service_arn_by_task_arn = {}
+        for svc in candidates:
+            for task_arn in svc.get_running_task_arns():
+                service_arn_by_task_arn[task_arn] = svc.service_arn
+        tasks_by_service_arn = {}
+        for task in common.describe_tasks(self.ecs_client, self.cluster_name, list(service_arn_by_task_arn)):
+            tasks_by_service_arn.setdefault(service_arn_by_task_arn[task['taskArn']], []).append(task)
+
+        unhealthy = []
+        for svc in services:
+            tasks = tasks_by_service_arn.get(svc.service_arn, [])
+            if svc in candidates and tasks \
+                    and svc.evaluate_task_health(tasks, constant.MINIMUM_HEALTHY_DESIRED_COUNT):
+                svc.service_healthy = True
+            else:
+                unhealthy.append(svc)
+        return unhealthy
+
+    # Conteneurs des tâches RUNNING de chaque service (arn de service -> conteneurs avec image et imageDigest)
+    # Un list_tasks par service, puis describe_tasks par lot de 100 pour tout l'environnement
+    def get_running_containers(self, services=None):
+        target_services = services if services is not None else self.ecs_services
+        service_arn_by_task_arn = {}
+        for svc in target_services:
+            for task_arn in svc.get_running_task_arns():
+                service_arn_by_task_arn[task_arn] = svc.service_arn
+        containers_by_service_arn = {s.service_arn: [] for s in target_services}
+        for task in common.describe_tasks(self.ecs_client, self.cluster_name, list(service_arn_by_task_arn)):
+            if task['lastStatus'] == 'RUNNING':
+                containers_by_service_arn[service_arn_by_task_arn[task['taskArn']]].extend(task['containers'])
+        return containers_by_service_arn
+
+    # Compte en un seul passage les tâches encore présentes de services en cours d'arrêt
+    # describe_services par lot de 10 (runningCount + pendingCount). list_tasks n'est appelé que pour les services
+    # annoncés sans tâche, pour confirmer un compteur qui peut être en retard sur l'état réel.
+    def poll_running_task_counts(self, services):
+        descriptions = common.describe_services(self.ecs_client, self.cluster_name,
+                                                [s.service_arn for s in services])
+        task_counts = {}
+        for svc in services:
+            description = descriptions.get(svc.service_arn, {})
+            task_count = description.get('runningCount', 0) + description.get('pendingCount', 0)
+            if task_count == 0:
+                task_count = len(svc.get_running_task_arns())
+            task_counts[svc] = task_count
+        return task_counts
 
     def get_active_and_pending_smuggler_jobs(self):
         return cloudwatch_manager.get_smuggler_metrics(self.workspace, self.color)
@@ -259,6 +630,7 @@ class EcsService:
     application_autoscaling_client = None
     max_capacity = None
     resource_id = None
+    min_capacity = None
     verify_rollout_complete = False
 
     def __init__(self, ecs_client, application_autoscaling_client, cluster_name, service_arn, max_capacity,
@@ -270,56 +642,87 @@ class EcsService:
         self.max_capacity = max_capacity
         self.resource_id = resource_id
 
+    # Nom du service sans son segment de couleur, en début ou en fin de nom uniquement, identique pour les deux
+    # environnements
+    # ex : lcdp-api-blue -> lcdp-api ; green-lcdp-api -> lcdp-api ; lcdp-bluebird-blue -> lcdp-bluebird
+    def get_uncolored_name(self):
+        return UNCOLORED_NAME_PATTERN.sub('', self.resource_id.split('/')[-1].lower())
+
     def get_running_task_arns(self):
-        tasks = self.ecs_client.list_tasks(
-            cluster=self.cluster_name,
-            serviceName=self.service_arn,
-            # TODO: Review if one day we got more than 100 ecs tasks !
-            maxResults=100
-        )
-        return tasks['taskArns']
+        return list(common.paginate(self.ecs_client, 'list_tasks', 'taskArns',
+                                    page_size=100,
+                                    cluster=self.cluster_name,
+                                    serviceName=self.service_arn))
 
     def __set_register_scalable_target(self, min_capacity):
         try:
-            return self.application_autoscaling_client.register_scalable_target(
-                ServiceNamespace=constant.ECS_SERVICE_NAMESPACE,
-                ResourceId=self.resource_id,
-                ScalableDimension=constant.DEFAULT_SCALABLE_DIMENSION,
-                MinCapacity=min_capacity,
-                MaxCapacity=self.max_capacity
-            )
+            return self.__register_scalable_target(min_capacity)
         except Exception as err:
             print("An exception was raise during creation of new scalable target. Error : {}".format(err))
 
+    # min_capacity n'est mis à jour qu'une fois la capacité enregistrée par AWS
+    def __register_scalable_target(self, min_capacity):
+        response = self.application_autoscaling_client.register_scalable_target(
+            ServiceNamespace=constant.ECS_SERVICE_NAMESPACE,
+            ResourceId=self.resource_id,
+            ScalableDimension=constant.DEFAULT_SCALABLE_DIMENSION,
+            MinCapacity=min_capacity,
+            MaxCapacity=self.max_capacity
+        )
+        self.min_capacity = min_capacity
+        return response
+
     def start(self, desired_count=None):
-        if not desired_count:
-            desired_count = constant.DEFAULT_DESIRED_COUNT
-        print('Start service {} with {} instances'.format(self.service_arn, desired_count))
-        # First update the ECS SHA1 image to pull (service still at desiredCount=0)
+        print('Start service {} with {} instances'.format(self.service_arn,
+                                                          desired_count or constant.DEFAULT_DESIRED_COUNT))
+        self.request_new_deployment()
+
+        # Then, wait for the deployment to be in place at desiredCount=0
+        print('Waiting for deployment of service {} to stabilize...'.format(self.service_arn))
+        with instrumentation.span('services_stable_waiter', service=self.resource_id):
+            waiter = self.ecs_client.get_waiter('services_stable')
+            waiter.wait(
+                cluster=self.cluster_name,
+                services=[self.service_arn],
+                WaiterConfig={
+                    'Delay': constant.SERVICES_STABLE_DELAY,
+                    'MaxAttempts': constant.SERVICES_STABLE_MAX_ATTEMPTS
+                }
+            )
+
+        self.enable_autoscaling(desired_count)
+
+    # First update the ECS SHA1 image to pull (service still at desiredCount=0)
+    def request_new_deployment(self):
         self.ecs_client.update_service(
             cluster=self.cluster_name,
             service=self.service_arn,
             forceNewDeployment=True
         )
 
-        # Then, wait for the deployment to be in place at desiredCount=0
-        print('Waiting for deployment of service {} to stabilize...'.format(self.service_arn))
-        waiter = self.ecs_client.get_waiter('services_stable')
-        waiter.wait(
-            cluster=self.cluster_name,
-            services=[self.service_arn],
-            WaiterConfig={
-                'Delay': 10,  # vérifie toutes les 10s
-                'MaxAttempts': 30  # timeout après 5 minutes
-            }
-        )
+    # Même critère que le waiter services_stable : un seul déploiement et autant de tâches que demandé
+    def is_stable(self, service_description):
+        if not service_description:
+            return False
+        return len(service_description.get('deployments', [])) == 1 \
+            and service_description['runningCount'] == service_description['desiredCount']
 
+    def enable_autoscaling(self, desired_count=None):
+        if not desired_count:
+            desired_count = constant.DEFAULT_DESIRED_COUNT
         # Re-enable AAS. AAS enforces MinCapacity by bumping desiredCount to desired_count itself,
         # so no concurrent update_service(desiredCount=...) is needed (avoids ConcurrentUpdateException).
         response = self.__set_register_scalable_target(desired_count)
         print("Started service: '{}', Updated Capacities => MaxCapacity: {} / MinCapacity: {}, response: {}"
               .format(self.service_arn, self.max_capacity, desired_count, response))
 
+    # Contrairement au démarrage et à l'arrêt, un échec est remonté à l'appelant
+    def set_min_capacity(self, min_capacity):
+        response = self.__register_scalable_target(min_capacity)
+        print("Updated capacities of service: '{}' => MaxCapacity: {} / MinCapacity: {}, response: {}"
+              .format(self.service_arn, self.max_capacity, min_capacity, response))
+        return response
+
     def shutdown(self):
         print('Shutdown service {}'.format(self.service_arn))
 
@@ -346,6 +749,8 @@ class EcsService:
         return self.__check_health_with_threshold(constant.DEFAULT_DESIRED_COUNT)
 
     def __check_health_with_threshold(self, min_healthy_count):
+        if not self.evaluate_service_description(self.__describe_service(), min_healthy_count):
+            return False
         tasks = self.get_running_task_arns()
         if not tasks:
             return False
@@ -353,15 +758,32 @@ class EcsService:
             cluster=self.cluster_name,
             tasks=tasks
         )
-        running_tasks = [t for t in detailed_task['tasks'] if t['lastStatus'] == 'RUNNING']
-        nb_healthy_task = len([t for t in running_tasks if t['healthStatus'] == 'HEALTHY'])
-        is_healthy = nb_healthy_task >= min_healthy_count
-
+        return self.evaluate_task_health(detailed_task['tasks'], min_healthy_count)
+
+    def evaluate_service_description(self, service_description, min_healthy_count):
+        """Rule out a service from its describe_services entry alone, without any task call.
+        Returns False when it has too few running tasks, when its rollout failed or, with rollout verification,
+        when old deployments still have running tasks. True means the task health still has to be checked:
+        a COMPLETED rollout does not cover tasks added afterwards by autoscaling."""
+        running_count = service_description.get('runningCount', 0)
+        if running_count < min_healthy_count:
+            print('{} has not reached the health threshold: {} running task(s), {} required'
+                  .format(self.service_arn, running_count, min_healthy_count))
+            return False
+        primary = next((d for d in service_description.get('deployments', []) if d['status'] == 'PRIMARY'), {})
+        if primary.get('rolloutState') == 'FAILED':
+            print('{} rollout failed: {}'.format(self.service_arn, primary.get('rolloutStateReason')))
+            return False
         # Verify the rolling update is fully complete (only PRIMARY deployment remains).
         # This prevents old version tasks from coexisting with new ones.
-        if is_healthy and self.verify_rollout_complete:
-            if not self.__has_completed_rollout():
-                return False
+        if self.verify_rollout_complete and not self.__has_completed_rollout(service_description):
+            return False
+        return True
+
+    def evaluate_task_health(self, tasks, min_healthy_count):
+        running_tasks = [t for t in tasks if t['lastStatus'] == 'RUNNING']
+        nb_healthy_task = len([t for t in running_tasks if t.get('healthStatus') == 'HEALTHY'])
+        is_healthy = nb_healthy_task >= min_healthy_count
 
         if is_healthy:
             print('{} has reached the health threshold with {} healthy task(s) (required: {})'
@@ -371,15 +793,17 @@ class EcsService:
                   .format(self.service_arn, nb_healthy_task, min_healthy_count))
         return is_healthy
 
-    def __has_completed_rollout(self):
-        """Check that no old deployment has running tasks, meaning the rolling update is done.
-        ECS may keep old deployment records briefly after tasks stop, so we check runningCount
-        rather than deployment count."""
+    def __describe_service(self):
         response = self.ecs_client.describe_services(
             cluster=self.cluster_name,
             services=[self.service_arn]
         )
-        service = response['services'][0]
+        return response['services'][0]
+
+    def __has_completed_rollout(self, service):
+        """Check that no old deployment has running tasks, meaning the rolling update is done.
+        ECS may keep old deployment records briefly after tasks stop, so we check runningCount
+        rather than deployment count."""
         deployments = service.get('deployments', [])
         old_deployments_with_tasks = [d for d in deployments
                                       if d['status'] != 'PRIMARY' and d['runningCount'] > 0]
@@ -402,14 +826,23 @@ class EcsService:
 class Repository:
     name = None
     image = None
-    manifest = None
     ecr_client = None
 
-    def __init__(self, ecr_client, name, image, manifest):
+    def __init__(self, ecr_client, name, image, manifest=None):
         self.ecr_client = ecr_client
         self.name = name
         self.image = image
-        self.manifest = manifest
+        self.__manifest = manifest
+
+    @property
+    def manifest(self):
+        # Le manifest n'est utile qu'au retag : il est chargé au premier besoin puis conservé
+        if self.__manifest is None:
+            self.__manifest = ecr_manager.get_image_manifest(self.name, self.image)
+        return self.__manifest
+
+    def add_tags(self, tags):
+        return [self.add_tag(tag) for tag in tags]
 
     def add_tag(self, tag):
         try:
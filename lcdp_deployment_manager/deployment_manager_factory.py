@@ -1,33 +1,76 @@
+
 from .deployment_manager \
     import DeploymentManager, Repository, Environment, EcsService
 from . import manage_ecr as ecr_manager
 from . import manage_alb as alb_manager
 from . import manage_ecs as ecs_manager
 from . import constant as constant
-import boto3
+from . import clients as clients
+from . import discovery_snapshot as discovery_snapshot
+from . import instrumentation as instrumentation
 
-# Client
-ecr_client = boto3.client('ecr')
-ecs_client = boto3.client('ecs')
-elbv2_client = boto3.client('elbv2')
-application_autoscaling_client = boto3.client('application-autoscaling')
 
+@instrumentation.entry_point
+def build_deployment_manager(alb_name, cluster_name, img_deploy_tag, ssl_enabled, workspace,
+                             concurrent=False, max_workers=constant.BUILD_MAX_WORKERS, snapshot_ttl=None):
+    """
+    Construit le DeploymentManager à partir de l'infrastructure AWS
+    :param concurrent:  Si vrai, la découverte des repositories et des environnements blue/green
+                        est répartie sur un pool de threads borné
+    :type concurrent:   bool
+    :param max_workers: Taille du pool de threads en mode concurrent
+    :type max_workers:  int
+    :param snapshot_ttl: Si renseigné, la topologie découverte est conservée sur disque (cf. discovery_snapshot)
+                         et réutilisée pendant ce nombre de secondes, seule la partie volatile est relue
+    :type snapshot_ttl:  int
+    """
+    # L'inventaire ECS d'une invocation précédente (Lambda chaude) n'est pas réutilisé
+    ecs_manager.clear_cluster_inventory(cluster_name)
+    if not snapshot_ttl:
+        return __discover(alb_name, cluster_name, img_deploy_tag, ssl_enabled, workspace, concurrent,
+                          max_workers)[0]
 
-def build_deployment_manager(alb_name, cluster_name, img_deploy_tag, ssl_enabled, workspace):
-    alb = alb_manager.get_alb_from_aws(alb_name)
-    listener = alb_manager.get_current_listener(alb['LoadBalancerArn'], ssl_enabled)
-    rules = alb_manager.get_uncolored_rules(listener)
-    active_color = alb_manager.get_active_color(listener)
-    current_target_group_type = alb_manager.get_active_type(listener)
-    repositories = list(
-        map(lambda x: __build_repository(x, img_deploy_tag), ecr_manager.get_service_repositories_name()))
-    green_environment = __build_environment(constant.GREEN, current_target_group_type,
-                                            cluster_name, workspace)
-    blue_environment = __build_environment(constant.BLUE, current_target_group_type,
-                                           cluster_name, workspace)
+    snapshot_path = discovery_snapshot.get_snapshot_path(alb_name, cluster_name, workspace, ssl_enabled)
+    snapshot = discovery_snapshot.load_snapshot(snapshot_path, snapshot_ttl)
+    if snapshot:
+        with instrumentation.span('build_from_snapshot'):
+            deployment_manager = __build_from_snapshot(snapshot, cluster_name, img_deploy_tag, ssl_enabled,
+                                                       workspace, max_workers)
+        if deployment_manager:
+            print('Deployment manager rebuilt from discovery snapshot {}'.format(snapshot_path))
+            return deployment_manager
+        print('Discovery snapshot {} no longer matches the infrastructure, discovering again'.format(snapshot_path))
+
+    deployment_manager, repository_names = __discover(alb_name, cluster_name, img_deploy_tag, ssl_enabled,
+                                                      workspace, concurrent, max_workers)
+    discovery_snapshot.save_snapshot(snapshot_path,
+                                     discovery_snapshot.build_snapshot(deployment_manager, repository_names))
+    return deployment_manager
+
+
+def __discover(alb_name, cluster_name, img_deploy_tag, ssl_enabled, workspace, concurrent, max_workers):
+    # Sans mode concurrent, le load balancer est décrit d'abord par le thread appelant, puis un seul worker exécute
+    # les étapes suivantes dans l'ordre : rien ne s'exécute en parallèle
+    alb_description = None if concurrent else __describe_alb(alb_name, ssl_enabled)
+    with instrumentation.TracedThreadPoolExecutor(max_workers=max_workers if concurrent else 1) as executor:
+        alb_future = executor.submit(__describe_alb, alb_name, ssl_enabled) if concurrent else None
+        repository_names = ecr_manager.get_service_repositories_name()
+        repository_futures = [executor.submit(__build_repository, x, img_deploy_tag)
+                              for x in repository_names]
+
+        alb, listener, rules, resource_tags, active_color, current_target_group_type = \
+            alb_future.result() if concurrent else alb_description
+        green_future = executor.submit(__build_environment, constant.GREEN, current_target_group_type,
+                                       cluster_name, workspace)
+        blue_future = executor.submit(__build_environment, constant.BLUE, current_target_group_type,
+                                      cluster_name, workspace)
+
+        repositories = [f.result() for f in repository_futures]
+        green_environment = green_future.result()
+        blue_environment = blue_future.result()
 
     return DeploymentManager(
-        elbv2_client=elbv2_client,
+        elbv2_client=clients.get_client('elbv2'),
         alb=alb,
         http_listener=listener,
         rules=[r for r in rules if r],
@@ -36,25 +79,101 @@ def build_deployment_manager(alb_name, cluster_name, img_deploy_tag, ssl_enabled
         repositories=[r for r in repositories if r],
         green_environment=green_environment,
         blue_environment=blue_environment,
+        resource_tags=resource_tags,
+    ), repository_names
+
+
+# Reconstruit le DeploymentManager depuis un instantané en ne relisant que la partie volatile :
+# listener (couleur et type actifs), actions des règles et images du tag de déploiement.
+# Retourne None si l'instantané ne correspond plus : listener, règles ou services du cluster différents.
+def __build_from_snapshot(snapshot, cluster_name, img_deploy_tag, ssl_enabled, workspace, max_workers):
+    alb = snapshot['alb']
+    listener = alb_manager.get_current_listener(alb['LoadBalancerArn'], ssl_enabled)
+    if not listener or listener['ListenerArn'] != snapshot['listener_arn']:
+        return None
+    rules = alb_manager.get_uncolored_rules(listener, snapshot['rule_tags'])
+    if {r['RuleArn'] for r in rules} != set(snapshot['rule_tags']):
+        return None
+
+    environments = snapshot['environments']
+    # Un seul list_services (paginé) : les services colorés du cluster doivent être ceux de l'instantané
+    snapshot_services_arn = {arn for e in environments.values() for arn in e['services']}
+    cluster_services_arn = {arn for arn in ecs_manager.get_services_from_cluster(cluster_name)['serviceArns']
+                            if constant.BLUE.upper() in arn.upper() or constant.GREEN.upper() in arn.upper()}
+    if cluster_services_arn != snapshot_services_arn:
+        return None
+
+    resource_tags = snapshot['resource_tags']
+    active_color = alb_manager.get_active_color(listener, resource_tags)
+    current_target_group_type = alb_manager.get_active_type(listener, resource_tags)
+    if any(e['target_group_type'] != current_target_group_type for e in environments.values()):
+        return None
+    # Le listener doit router vers le target group de la couleur active, et les deux doivent toujours exister :
+    # un target group recréé entre-temps ferait basculer les règles vers un arn supprimé
+    target_group_arns = {color: e['target_group_arn'] for color, e in environments.items()}
+    if alb_manager.get_active_target_group_arn(listener) != target_group_arns.get(active_color) \
+            or not alb_manager.target_groups_exist(target_group_arns.values()):
+        return None
+
+    repository_names = snapshot['repository_names']
+    with instrumentation.TracedThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(repository_names)))) as executor:
+        repositories = list(executor.map(lambda x: __build_repository(x, img_deploy_tag), repository_names))
+
+    green_environment, blue_environment = [Environment(
+        workspace=workspace,
+        color=color,
+        target_group_type=current_target_group_type,
+        cluster_name=cluster_name,
+        ecs_client=clients.get_client('ecs'),
+        ecs_services=[build_service(cluster_name, arn, max_capacity)
+                      for arn, max_capacity in environments[color]['services'].items()],
+        target_group_arn=environments[color]['target_group_arn'],
+    ) for color in (constant.GREEN, constant.BLUE)]
+
+    return DeploymentManager(
+        elbv2_client=clients.get_client('elbv2'),
+        alb=alb,
+        http_listener=listener,
+        rules=rules,
+        active_color=active_color,
+        current_target_group_type=current_target_group_type,
+        repositories=[r for r in repositories if r],
+        green_environment=green_environment,
+        blue_environment=blue_environment,
+        resource_tags=resource_tags,
     )
 
 
+def __describe_alb(alb_name, ssl_enabled):
+    alb = alb_manager.get_alb_from_aws(alb_name)
+    listener = alb_manager.get_current_listener(alb['LoadBalancerArn'], ssl_enabled)
+    rules = alb_manager.get_uncolored_rules(listener)
+    # Cache de tags partagé avec le DeploymentManager pour éviter un describe_tags par target group
+    resource_tags = {}
+    active_color = alb_manager.get_active_color(listener, resource_tags)
+    current_target_group_type = alb_manager.get_active_type(listener, resource_tags)
+    return alb, listener, rules, resource_tags, active_color, current_target_group_type
+
+
 def __build_repository(repository_name, tag):
     image = ecr_manager.get_repository_image_for_tag(repository_name, tag)
     if image:
-        image_manifest = ecr_manager.get_image_manifest(repository_name, image)
+        # Le manifest n'est chargé qu'au premier retag (cf. Repository.manifest)
         return Repository(
             name=repository_name,
-            ecr_client=ecr_client,
-            image=image,
-            manifest=image_manifest
+            ecr_client=clients.get_client('ecr'),
+            image=image
         )
 
 
-def build_service(cluster_name, service_arn):
-    return EcsService(ecs_client=ecs_client, application_autoscaling_client=application_autoscaling_client,
+def build_service(cluster_name, service_arn, max_capacity=None):
+    if max_capacity is None:
+        max_capacity = ecs_manager.get_cluster_inventory(cluster_name).get_max_capacity(service_arn)
+    return EcsService(ecs_client=clients.get_client('ecs'),
+                      application_autoscaling_client=clients.get_client('application-autoscaling'),
                       cluster_name=cluster_name, service_arn=service_arn,
-                      max_capacity=ecs_manager.get_service_max_capacity_from_service_arn(service_arn),
+                      max_capacity=max_capacity,
                       resource_id=ecs_manager.get_service_resource_id_from_service_arn(service_arn))
 
 
@@ -70,7 +189,7 @@ def __build_environment(color, target_group_type, cluster_name, workspace):
         color=color,
         target_group_type=target_group_type,
         cluster_name=cluster_name,
-        ecs_client=ecs_client,
+        ecs_client=clients.get_client('ecs'),
         ecs_services=[s for s in ecs_services if s],
         target_group_arn=alb_manager.get_target_group_with_type_color_and_workspace(
             target_group_type, color, workspace
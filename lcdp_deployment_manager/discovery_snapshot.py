@@ -0,0 +1,75 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from . import constant as constant
+
+###
+#   Instantané de la topologie découverte par build_deployment_manager, conservé sur disque (/tmp) pour être
+#   réutilisé par les invocations suivantes d'une Lambda restée chaude.
+#   Seule la partie stable est conservée : load balancer, arn du listener, tags des règles et des target groups,
+#   target groups et services (avec leur capacité max) de chaque couleur, noms des repositories.
+#   La partie volatile (actions du listener et des règles, couleur active, digests des images, santé des tâches)
+#   est toujours relue.
+###
+
+
+def get_snapshot_path(alb_name, cluster_name, workspace, ssl_enabled, directory=constant.SNAPSHOT_DIRECTORY):
+    key = '|'.join([alb_name, cluster_name, workspace, str(bool(ssl_enabled))])
+    return os.path.join(directory, 'lcdp-deployment-snapshot-{}.json.gz'.format(
+        hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+
+def build_snapshot(deployment_manager, repository_names):
+    return {
+        'version': constant.SNAPSHOT_VERSION,
+        'created_at': time.time(),
+        'alb': deployment_manager.alb,
+        'listener_arn': deployment_manager.http_listener['ListenerArn'],
+        'rule_tags': {r['RuleArn']: r.get('Tags', []) for r in deployment_manager.rules},
+        'resource_tags': deployment_manager.resource_tags,
+        'environments': {
+            environment.color: {
+                'target_group_type': environment.target_group_type,
+                'target_group_arn': environment.target_group_arn,
+                'services': {s.service_arn: s.max_capacity for s in environment.ecs_services},
+            } for environment in (deployment_manager.blue_environment, deployment_manager.green_environment)
+        },
+        'repository_names': list(repository_names),
+    }
+
+
+# Charge un instantané, None s'il est absent, illisible, d'une autre version ou plus vieux que ttl secondes
+def load_snapshot(path, ttl):
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (OSError, ValueError) as err:
+        if os.path.exists(path):
+            print('Unable to read discovery snapshot {}: {}'.format(path, err))
+        return None
+    if snapshot.get('version') != constant.SNAPSHOT_VERSION:
+        return None
+    age = time.time() - snapshot.get('created_at', 0)
+    if age > ttl:
+        print('Discovery snapshot {} expired ({}s old)'.format(path, int(age)))
+        return None
+    return snapshot
+
+
+# Ecrit un instantané de façon atomique : une invocation concurrente lit l'ancien ou le nouveau fichier, jamais un mélange
+def save_snapshot(path, snapshot):
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.lcdp-snapshot-')
+        with os.fdopen(fd, 'wb') as raw_file, gzip.GzipFile(fileobj=raw_file, mode='wb') as snapshot_file:
+            snapshot_file.write(json.dumps(snapshot, separators=(',', ':'), default=str).encode('utf-8'))
+        os.replace(tmp_path, path)
+    except OSError as err:
+        # Le cache n'est qu'une optimisation : un échec d'écriture ne doit pas faire échouer le déploiement
+        print('Unable to write discovery snapshot {}: {}'.format(path, err))
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
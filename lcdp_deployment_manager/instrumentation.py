@@ -0,0 +1,233 @@
+import functools
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from . import constant as constant
+
+THROTTLING_ERROR_CODES = {'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+                          'TooManyRequestsException', 'RequestThrottled', 'RequestThrottledException',
+                          'SlowDown'}
+
+
+###
+#   Enregistre la durée des phases d'un déploiement (spans) et les appels AWS qu'elles font
+#   Les spans sont imbriqués par thread ; un appel AWS est rattaché au span ouvert dans son thread.
+#   Les tâches d'un TracedThreadPoolExecutor héritent du span ouvert par le thread qui les a soumises.
+###
+class Tracer:
+    spans = []
+    api_calls = {}
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.spans = []
+            self.api_calls = {}
+            self.__span_ids = itertools.count(1)
+
+    def __current_stack(self):
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = []
+        return self.__local.stack
+
+    def current_span(self):
+        stack = self.__current_stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name, **attributes):
+        stack = self.__current_stack()
+        with self.__lock:
+            span = {
+                'id': next(self.__span_ids),
+                'parent_id': stack[-1]['id'] if stack else None,
+                'name': name,
+                'thread': threading.current_thread().name,
+                'start': time.time(),
+                'duration': None,
+                'error': None,
+                'api_calls': 0,
+                'retries': 0,
+                'throttles': 0,
+                'attributes': attributes,
+            }
+            self.spans.append(span)
+        stack.append(span)
+        try:
+            yield span
+        except Exception as err:
+            span['error'] = '{}: {}'.format(type(err).__name__, err)
+            raise
+        finally:
+            stack.pop()
+            span['duration'] = time.time() - span['start']
+
+    def bind(self, func):
+        """Return func wrapped to run under the span open in the calling thread, whatever thread runs it:
+        spans it opens get that span as parent and its AWS calls are counted on it."""
+        parent = self.current_span()
+        if parent is None:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = self.__current_stack()
+            stack.append(parent)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stack.pop()
+        return wrapper
+
+    def record_api_call(self, operation, duration, retries=0):
+        span = self.current_span()
+        with self.__lock:
+            stats = self.__get_api_stats(operation)
+            stats['count'] += 1
+            stats['duration'] += duration
+            stats['retries'] += retries
+            if span is not None:
+                span['api_calls'] += 1
+                span['retries'] += retries
+
+    def record_throttle(self, operation):
+        span = self.current_span()
+        with self.__lock:
+            self.__get_api_stats(operation)['throttles'] += 1
+            if span is not None:
+                span['throttles'] += 1
+
+    def __get_api_stats(self, operation):
+        return self.api_calls.setdefault(operation, {'count': 0, 'duration': 0.0, 'retries': 0, 'throttles': 0})
+
+    def to_dict(self):
+        with self.__lock:
+            return {
+                'spans': [dict(s) for s in self.spans],
+                'api_calls': {op: dict(stats) for op, stats in self.api_calls.items()},
+            }
+
+    def export_json(self, path=None):
+        """Return the trace as a JSON document, also written to path when given."""
+        document = json.dumps(self.to_dict(), default=str)
+        if path:
+            with open(path, 'w') as trace_file:
+                trace_file.write(document)
+        return document
+
+    def to_emf_lines(self, namespace=constant.TRACE_EMF_NAMESPACE, dimensions=None):
+        """Return the trace as CloudWatch Embedded Metric Format lines: one per finished span (Duration,
+        ApiCalls, Retries, Throttles with a Phase dimension) and one per AWS operation (Operation dimension).
+        Printed from a Lambda, these lines are turned into metrics by CloudWatch Logs."""
+        dimensions = dimensions or {}
+        trace = self.to_dict()
+        timestamp = int(time.time() * 1000)
+        lines = []
+        for span in trace['spans']:
+            if span['duration'] is None:
+                continue
+            lines.append(self.__emf_line(namespace, timestamp, dict(dimensions, Phase=span['name']), {
+                'Duration': (span['duration'] * 1000, 'Milliseconds'),
+                'ApiCalls': (span['api_calls'], 'Count'),
+                'Retries': (span['retries'], 'Count'),
+                'Throttles': (span['throttles'], 'Count'),
+            }))
+        for operation, stats in trace['api_calls'].items():
+            lines.append(self.__emf_line(namespace, timestamp, dict(dimensions, Operation=operation), {
+                'Calls': (stats['count'], 'Count'),
+                'Duration': (stats['duration'] * 1000, 'Milliseconds'),
+                'Retries': (stats['retries'], 'Count'),
+                'Throttles': (stats['throttles'], 'Count'),
+            }))
+        return lines
+
+    def __emf_line(self, namespace, timestamp, dimensions, metrics):
+        document = {
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()],
+                }],
+            },
+        }
+        document.update(dimensions)
+        document.update({name: value for name, (value, _) in metrics.items()})
+        return json.dumps(document)
+
+
+tracer = Tracer()
+
+
+def span(name, **attributes):
+    return tracer.span(name, **attributes)
+
+
+# Pool de threads dont les tâches s'exécutent sous le span ouvert par le thread qui les soumet (cf. Tracer.bind)
+class TracedThreadPoolExecutor(ThreadPoolExecutor):
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(tracer.bind(fn), *args, **kwargs)
+
+
+# Décorateur ouvrant un span au nom de la fonction pour chacun de ses appels
+def traced(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with tracer.span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# Décorateur d'un point d'entrée (début d'une invocation) : comme traced, après avoir vidé le tracer pour que la
+# trace ne couvre que cette invocation. Sans effet sur le tracer s'il est appelé sous un span déjà ouvert.
+def entry_point(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if tracer.current_span() is None:
+            tracer.reset()
+        with tracer.span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# Branche un client boto3 sur le tracer : durée, nombre de tentatives et throttling de chaque appel
+# Les événements botocore couvrent aussi les appels faits par les paginators et les waiters.
+def instrument_client(client):
+    events = client.meta.events
+    events.register('before-call.*.*', __before_call, unique_id='lcdp-trace-before-call')
+    events.register('after-call.*.*', __after_call, unique_id='lcdp-trace-after-call')
+    events.register('needs-retry.*.*', __needs_retry, unique_id='lcdp-trace-needs-retry')
+    return client
+
+
+def __before_call(context, **kwargs):
+    context['lcdp_trace_start'] = time.time()
+
+
+def __after_call(model, parsed, context, **kwargs):
+    duration = time.time() - context.get('lcdp_trace_start', time.time())
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0) if parsed else 0
+    tracer.record_api_call(__operation_name(model), duration, retries)
+
+
+def __needs_retry(response, operation, **kwargs):
+    if response is None:
+        return None
+    error_code = response[1].get('Error', {}).get('Code') if response[1] else None
+    if error_code in THROTTLING_ERROR_CODES:
+        tracer.record_throttle(__operation_name(operation))
+    # Ne décide rien : le handler de retry de botocore reste seul juge
+    return None
+
+
+def __operation_name(model):
+    return '{}.{}'.format(model.service_model.service_name, model.name)
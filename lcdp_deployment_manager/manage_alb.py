@@ -1,9 +1,6 @@
-import boto3
+from . import common as common
 from . import constant as constant
-
-# Client
-elbv2_client = boto3.client('elbv2')
-tagging_client = boto3.client('resourcegroupstaggingapi')
+from . import clients as clients
 
 
 # ~~~~~~~~~~~~~~~~ ALB ~~~~~~~~~~~~~~~~
@@ -16,7 +13,7 @@ def get_alb_from_aws(alb_name):
     :return:            Load balancer trouvé
     :rtype:             dict
     """
-    alb_desc = elbv2_client.describe_load_balancers(
+    alb_desc = clients.get_client('elbv2').describe_load_balancers(
         Names=[alb_name]
     )
     # WARNING: If we got multiple alb
@@ -26,33 +23,48 @@ def get_alb_from_aws(alb_name):
 # ~~~~~~~~~~~~~~~~ Listener ~~~~~~~~~~~~~~~~
 
 def get_current_listener(alb_arn, ssl_enabled):
-    alb_desc = elbv2_client.describe_listeners(
+    alb_desc = clients.get_client('elbv2').describe_listeners(
         LoadBalancerArn=alb_arn
     )
     return __get_listener(alb_desc, ssl_enabled)
 
 
-def get_active_color(listener):
+def get_active_color(listener, tags_cache=None):
     """
     Recupere la couleur de l'environnement actif (celui qui recoit le trafic)
     :param listener:    listener actuel
     :type listener:     dict
+    :param tags_cache:  cache arn -> tags a utiliser (optionnel)
+    :type tags_cache:   dict
     :return:            BLUE/GREEN
     :rtype:             str
     """
     current_target_group_arn = __get_default_forward_target_group_arn_from_listener(listener)
-    return __get_color_from_resource(current_target_group_arn)
+    return __get_color_from_resource(current_target_group_arn, tags_cache)
 
-def get_active_type(listener):
+def get_active_type(listener, tags_cache=None):
     """
     Recupere le type de l'environnement actif
     :param listener:    listener actuel
     :type listener:     dict
+    :param tags_cache:  cache arn -> tags a utiliser (optionnel)
+    :type tags_cache:   dict
     :return:            default/maintenance
     :rtype:             str
     """
     current_target_group_arn = __get_default_forward_target_group_arn_from_listener(listener)
-    return get_type_from_resource(current_target_group_arn)
+    return get_type_from_resource(current_target_group_arn, tags_cache)
+
+
+def get_active_target_group_arn(listener):
+    """
+    Recupere le target group qui recoit le trafic par defaut du listener (le plus pondere)
+    :param listener:    listener actuel
+    :type listener:     dict
+    :return:            arn du target group
+    :rtype:             str
+    """
+    return __get_default_forward_target_group_arn_from_listener(listener)
 
 
 def __get_listener(listeners, ssl_enabled):
@@ -73,10 +85,11 @@ def __get_listener(listeners, ssl_enabled):
 
 
 def __get_default_forward_target_group_arn_from_listener(listener):
-    # Careful if we got multiple forward target group
+    # With a weighted forward, the target group receiving most of the traffic is the active one
     for action in listener['DefaultActions']:
         if action['Type'] == 'forward':
-            return action['TargetGroupArn']
+            weights = common.get_forward_target_group_weights(action)
+            return max(weights, key=weights.get)
 
 
 def __get_tags_from_resource(resource_arn):
@@ -87,39 +100,67 @@ def __get_tags_from_resource(resource_arn):
     :return:                tag value
     :rtype:                 str
     """
-    tag_desc = elbv2_client.describe_tags(
+    tag_desc = clients.get_client('elbv2').describe_tags(
         ResourceArns=[resource_arn]
     )
     tags = tag_desc['TagDescriptions'][0]['Tags']
     return tags
 
-def __get_tag_value_from_resource(resource_arn, tag_name):
-    tags = __get_tags_from_resource(resource_arn)
+def __get_tag_value_from_resource(resource_arn, tag_name, tags_cache=None):
+    if tags_cache is not None:
+        tags = get_tags_for_resources([resource_arn], tags_cache)[resource_arn]
+    else:
+        tags = __get_tags_from_resource(resource_arn)
     for tag in tags:
         if tag['Key'] == tag_name:
             return tag['Value']
 
 
-def __get_color_from_resource(resource_arn):
+def __get_color_from_resource(resource_arn, tags_cache=None):
     """
     Récupère la couleur d'une ressource donnée
     :param resource_arn:    Ressource AWS arn
     :type resource_arn:     str
+    :param tags_cache:      cache arn -> tags a utiliser (optionnel)
+    :type tags_cache:       dict
     :return:                BLUE/GREEN
     :rtype:                 str
     """
-    return __get_tag_value_from_resource(resource_arn, constant.TARGET_GROUP_COLOR_TAG_NAME)
+    return __get_tag_value_from_resource(resource_arn, constant.TARGET_GROUP_COLOR_TAG_NAME, tags_cache)
 
 
-def get_type_from_resource(resource_arn):
+def get_type_from_resource(resource_arn, tags_cache=None):
     """
     Récupère le type d'une ressource donnée
     :param resource_arn:    Ressource AWS arn
     :type resource_arn:     str
+    :param tags_cache:      cache arn -> tags a utiliser (optionnel)
+    :type tags_cache:       dict
     :return:                default/maintenance
     :rtype:                 str
     """
-    return __get_tag_value_from_resource(resource_arn, constant.TARGET_GROUP_TYPE_TAG_NAME)
+    return __get_tag_value_from_resource(resource_arn, constant.TARGET_GROUP_TYPE_TAG_NAME, tags_cache)
+
+
+def get_tags_for_resources(resource_arns, tags_cache=None):
+    """
+    Récupère les tags de plusieurs ressources en regroupant les appels (20 arn par describe_tags)
+    Seules les ressources absentes du cache sont demandées à AWS, le cache est complété en place.
+    :param resource_arns:   Ressources AWS arn
+    :type resource_arns:    list
+    :param tags_cache:      cache arn -> tags à compléter (optionnel)
+    :type tags_cache:       dict
+    :return:                cache arn -> tags
+    :rtype:                 dict
+    """
+    if tags_cache is None:
+        tags_cache = {}
+    missing_arns = [arn for arn in dict.fromkeys(resource_arns) if arn and arn not in tags_cache]
+    if missing_arns:
+        tags_cache.update(__batch_describe_tags(missing_arns))
+        for arn in missing_arns:
+            tags_cache.setdefault(arn, [])
+    return tags_cache
 
 
 # ~~~~~~~~~~~~~~~~ Rules ~~~~~~~~~~~~~~~~
@@ -127,34 +168,50 @@ def get_type_from_resource(resource_arn):
 
 # Récupère les règles qui n'ont pas une couleur dans l'url
 # ex : blue.beta.verde -> NON ; beta.verde -> OUI
-def get_uncolored_rules(listener):
-    rules_desc = elbv2_client.describe_rules(
-        ListenerArn=listener['ListenerArn']
-    )
-    uncolored_rules = []
-    for rule in rules_desc['Rules']:
-        is_colored = False
-        for condition in rule['Conditions']:
-            host = condition.get('HostHeaderConfig', None)
-            if host:
-                is_colored = any(__is_colored_host_header_value(v) for v in host['Values'])
-
-        if not is_colored:
-            uncolored_rules.append(rule)
-
-    non_default_arns = [r['RuleArn'] for r in uncolored_rules if not r['IsDefault']]
-    tags_by_arn = __batch_describe_tags(non_default_arns)
+# rule_tags (arn de règle -> tags) évite le describe_tags des règles déjà connues
+def get_uncolored_rules(listener, rule_tags=None):
+    uncolored_rules = [rule for rule in common.paginate(clients.get_client('elbv2'), 'describe_rules', 'Rules',
+                                                        ListenerArn=listener['ListenerArn'])
+                       if is_uncolored_rule(rule)]
+
+    tags_by_arn = dict(rule_tags or {})
+    non_default_arns = [r['RuleArn'] for r in uncolored_rules if not r['IsDefault'] and r['RuleArn'] not in tags_by_arn]
+    tags_by_arn.update(__batch_describe_tags(non_default_arns))
     for rule in uncolored_rules:
         rule['Tags'] = tags_by_arn.get(rule.get('RuleArn', ''), [])
 
     return uncolored_rules
 
 
+# Indique si une règle n'a pas de couleur dans les host headers de ses conditions
+def is_uncolored_rule(rule):
+    is_colored = False
+    for condition in rule['Conditions']:
+        host = condition.get('HostHeaderConfig', None)
+        if host:
+            is_colored = any(__is_colored_host_header_value(v) for v in host['Values'])
+    return not is_colored
+
+
+# Récupère les host headers des règles colorées d'une couleur donnée (sans joker)
+# ex : pour blue -> blue.beta.verde
+def get_colored_host_headers(listener, color):
+    host_headers = []
+    for rule in common.paginate(clients.get_client('elbv2'), 'describe_rules', 'Rules',
+                                ListenerArn=listener['ListenerArn']):
+        for condition in rule['Conditions']:
+            host = condition.get('HostHeaderConfig', None)
+            if host:
+                host_headers.extend(v for v in host['Values']
+                                    if color in v and '*' not in v and '?' not in v and v not in host_headers)
+    return host_headers
+
+
 def __batch_describe_tags(arns):
     tags_by_arn = {}
     for i in range(0, len(arns), 20):
         chunk = arns[i:i + 20]
-        response = elbv2_client.describe_tags(ResourceArns=chunk)
+        response = clients.get_client('elbv2').describe_tags(ResourceArns=chunk)
         for desc in response['TagDescriptions']:
             tags_by_arn[desc['ResourceArn']] = desc['Tags']
     return tags_by_arn
@@ -166,6 +223,36 @@ def __is_colored_host_header_value(value):
 
 # ~~~~~~~~~~~~~~~~ TARGET GROUP ~~~~~~~~~~~~~~~~
 
+
+# Vérifie en un seul describe_target_groups que des target groups existent toujours
+def target_groups_exist(target_group_arns):
+    target_group_arns = list(target_group_arns)
+    client = clients.get_client('elbv2')
+    try:
+        response = client.describe_target_groups(TargetGroupArns=list(target_group_arns))
+    except client.exceptions.TargetGroupNotFoundException:
+        return False
+    return {tg['TargetGroupArn'] for tg in response['TargetGroups']} == set(target_group_arns)
+
+
+def get_target_health_counts(target_group_arn):
+    """
+    Compte les cibles d'un target group par état (healthy, initial, draining, unhealthy...)
+    :param target_group_arn:    Target group arn
+    :type target_group_arn:     str
+    :return:                    état -> nombre de cibles
+    :rtype:                     dict
+    """
+    response = clients.get_client('elbv2').describe_target_health(
+        TargetGroupArn=target_group_arn
+    )
+    counts = {}
+    for description in response['TargetHealthDescriptions']:
+        state = description['TargetHealth']['State']
+        counts[state] = counts.get(state, 0) + 1
+    return counts
+
+
 def get_target_group_with_type_color_and_workspace(tg_type, color, workspace):
     """
     Récupère un target group ayant un type et une couleur précise
@@ -203,15 +290,16 @@ def get_target_group_with_type_color_and_workspace(tg_type, color, workspace):
             ]
         })
 
-    response = tagging_client.get_resources(
+    resources = list(common.paginate(
+        clients.get_client('resourcegroupstaggingapi'), 'get_resources', 'ResourceTagMappingList',
         TagFilters=tag_filter,
         ResourceTypeFilters=[
             'elasticloadbalancing:targetgroup',
         ],
-    )
+    ))
 
-    if len(response['ResourceTagMappingList']) != 1:
+    if len(resources) != 1:
         raise Exception('Expected one target group with type {}, color {}, and workspace {}. But found {}'
-                        .format(tg_type, color, workspace, str(len(response['ResourceTagMappingList']))))
+                        .format(tg_type, color, workspace, str(len(resources))))
 
-    return response['ResourceTagMappingList'][0]['ResourceARN']
+    return resources[0]['ResourceARN']
@@ -1,10 +1,9 @@
 from datetime import datetime, timezone, timedelta
 
-import boto3
-
 import logging
 
-cloudwatch_client = boto3.client('cloudwatch')
+from . import clients as clients
+
 
 def __search_expression(env, env_color, metric_name, aggregator):
     return "SEARCH('{{LCDP-SMUGGLER,ServiceEnvironment,ServiceVersion,SmugglerId}} MetricName=\"{metric_name}\" ServiceEnvironment=\"{service_environment}\" ServiceVersion=\"{service_version}\"', '{aggregator}', 30)".format(metric_name=metric_name, service_environment=env, service_version=env_color, aggregator=aggregator)
@@ -19,7 +18,7 @@ def get_smuggler_metrics(env, env_color):
     end_time = datetime.now(timezone.utc)
     start_time = end_time - timedelta(minutes=3)
 
-    response = cloudwatch_client.get_metric_data(
+    response = clients.get_client('cloudwatch').get_metric_data(
         MetricDataQueries=[
             {
                 'Id': 'active_jobs',
@@ -52,3 +51,49 @@ def get_smuggler_metrics(env, env_color):
         logging.exception("An error occured while retrieving 'pending_jobs'")
 
     return metrics
+
+
+def __target_group_metric_query(query_id, metric_name, stat, load_balancer_arn, target_group_arn):
+    return {
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {
+                'Namespace': 'AWS/ApplicationELB',
+                'MetricName': metric_name,
+                'Dimensions': [
+                    # Les dimensions attendent la fin des arn : app/<nom>/<id> et targetgroup/<nom>/<id>
+                    {'Name': 'LoadBalancer', 'Value': load_balancer_arn.split(':loadbalancer/')[-1]},
+                    {'Name': 'TargetGroup', 'Value': target_group_arn.split(':')[-1]},
+                ],
+            },
+            'Period': 60,
+            'Stat': stat,
+        },
+    }
+
+
+def get_target_group_metrics(load_balancer_arn, target_group_arn, minutes=2):
+    """Latence p95 (secondes), nombre de 5xx et nombre de requetes d'un target group sur les dernieres minutes"""
+    end_time = datetime.now(timezone.utc)
+    start_time = end_time - timedelta(minutes=minutes)
+
+    response = clients.get_client('cloudwatch').get_metric_data(
+        MetricDataQueries=[
+            __target_group_metric_query('p95_latency', 'TargetResponseTime', 'p95',
+                                        load_balancer_arn, target_group_arn),
+            __target_group_metric_query('http_5xx', 'HTTPCode_Target_5XX_Count', 'Sum',
+                                        load_balancer_arn, target_group_arn),
+            __target_group_metric_query('requests', 'RequestCount', 'Sum',
+                                        load_balancer_arn, target_group_arn),
+        ],
+        StartTime=start_time,
+        EndTime=end_time,
+        ScanBy='TimestampDescending'
+    )
+
+    metrics = dict()
+    for metric_name, aggregator in (('p95_latency', max), ('http_5xx', sum), ('requests', sum)):
+        values = [v for x in response['MetricDataResults'] if x['Id'] == metric_name for v in x['Values']]
+        if values:
+            metrics[metric_name] = aggregator(values)
+    return metrics
@@ -1,51 +1,69 @@
-import boto3
+from . import common as common
 from . import constant as constant
-
-ecr_client = boto3.client('ecr')
+from . import clients as clients
+from . import instrumentation as instrumentation
 
 
 # Récupère le nom des ECR qui sont des services
 # Un service commence par 'lcdp-'
 def get_service_repositories_name():
-    repositories = ecr_client.describe_repositories()
     service_repositories = []
-    for repository in repositories['repositories']:
+    for repository in common.paginate(clients.get_client('ecr'), 'describe_repositories', 'repositories'):
         if repository['repositoryName'].startswith(constant.ECR_SERVICE_PREFIX):
             service_repositories.append(repository['repositoryName'])
     return service_repositories
 
 
-# Récupère une image possédant un tag précis
+# Récupère une image possédant un tag précis, le parcours s'arrête à la première image trouvée
 def get_repository_image_for_tag(repository_name, tag):
-    images = ecr_client.list_images(
-        repositoryName=repository_name,
-        # TODO: Review if one day we got more than 1000 ecr images !
-        maxResults=1000
-    )
-    for image in images['imageIds']:
-        if 'imageTag' in image and image['imageTag'].upper() == tag.upper():
+    for image in __iter_tagged_images(repository_name):
+        if image['imageTag'].upper() == tag.upper():
             return image
 
 
+# Indexe les images taggées d'un repository par tag (en majuscule) en un seul parcours paginé de list_images
+def get_repository_image_index(repository_name):
+    image_index = {}
+    for image in __iter_tagged_images(repository_name):
+        image_index.setdefault(image['imageTag'].upper(), image)
+    return image_index
+
+
+def __iter_tagged_images(repository_name):
+    images = common.paginate(clients.get_client('ecr'), 'list_images', 'imageIds',
+                             page_size=constant.ECR_LIST_IMAGES_PAGE_SIZE,
+                             repositoryName=repository_name, filter={'tagStatus': 'TAGGED'})
+    return (image for image in images if 'imageTag' in image)
+
+
 # Récupère la liste des images pour lesquelles le tag n'est pas le même que la couleur active
-def find_mismatched_repositories_between_tag_and_color(repositories_name, tag, color):
-    mismatched_repositories_name = []
+# Les repositories sont vérifiés en parallèle, avec un seul parcours des images par repository
+def find_mismatched_repositories_between_tag_and_color(repositories_name, tag, color,
+                                                       max_workers=constant.BUILD_MAX_WORKERS):
+    if not repositories_name:
+        return []
+
+    with instrumentation.TracedThreadPoolExecutor(max_workers=min(max_workers, len(repositories_name))) as executor:
+        mismatches = list(executor.map(lambda r: __is_mismatched_repository(r, tag, color), repositories_name))
+
+    return [r for r, is_mismatched in zip(repositories_name, mismatches) if is_mismatched]
 
-    for repository_name in repositories_name:
-        tag_image = get_repository_image_for_tag(repository_name, tag)
-        color_image = get_repository_image_for_tag(repository_name, color)
 
-        if tag_image and color_image and tag_image['imageDigest'] != color_image['imageDigest']:
-            print('Mismatched image for repository: {}'.format(repository_name))
-            mismatched_repositories_name.append(repository_name)
+def __is_mismatched_repository(repository_name, tag, color):
+    image_index = get_repository_image_index(repository_name)
+    tag_image = image_index.get(tag.upper())
+    color_image = image_index.get(color.upper())
 
-    return mismatched_repositories_name
+    if tag_image and color_image and tag_image['imageDigest'] != color_image['imageDigest']:
+        print('Mismatched image for repository: {}'.format(repository_name))
+        return True
+    return False
 
 
 # Récupère le manifest d'une image
 def get_image_manifest(repository_name, image):
-    detailed_image = ecr_client.batch_get_image(
+    detailed_image = clients.get_client('ecr').batch_get_image(
         repositoryName=repository_name,
         imageIds=[image]
     )
-    return detailed_image['images'][0]['imageManifest']
\ No newline at end of file
+    return detailed_image['images'][0]['imageManifest']
@@ -1,46 +1,140 @@
-import boto3
+import threading
+import time
 
+from . import common as common
 from . import constant as constant
+from . import clients as clients
+from . import instrumentation as instrumentation
 from .deployment_manager \
     import EcsService
 
-ecs_client = boto3.client('ecs')
-application_autoscaling_client = boto3.client('application-autoscaling')
-
 
+###
+#   Inventaire des services d'un cluster
+#   list_services est parcouru une seule fois (paginé), puis describe_services (avec les tags) par lot de 10.
+#   Les services sont indexés par arn, couleur et repository d'image.
+###
+class ClusterInventory:
+    cluster_name = None
+    ttl = None
+    created_at = None
+    services_arn = []
+    services_by_arn = {}
+
+    def __init__(self, cluster_name, ttl=constant.ECS_INVENTORY_TTL):
+        self.cluster_name = cluster_name
+        self.ttl = ttl
+        self.refresh()
+
+    def refresh(self):
+        services_arn = list(common.paginate(clients.get_client('ecs'), 'list_services', 'serviceArns',
+                                            cluster=self.cluster_name))
+        self.services_arn = services_arn
+        self.services_by_arn = common.describe_services(clients.get_client('ecs'), self.cluster_name, services_arn,
+                                                        include=['TAGS'])
+        self.__repository_name_by_arn = {}
+        self.created_at = time.time()
+
+    def is_expired(self):
+        return time.time() - self.created_at > self.ttl
+
+    def get_services_arn_from_query(self, q):
+        return [arn for arn in self.services_arn if q.upper() in arn.upper()]
+
+    def get_services_arn_for_color(self, color):
+        return self.get_services_arn_from_query(color)
+
+    def get_max_capacity(self, service_arn):
+        return get_max_capacity_from_tags(self.services_by_arn.get(service_arn, {}).get('tags'))
+
+    # Nom du repository ECR de l'image du premier conteneur du service
+    def get_repository_name(self, service_arn):
+        return self.get_repository_names([service_arn])[service_arn]
+
+    # Noms des repositories de plusieurs services, une seule lecture par révision de task definition
+    def get_repository_names(self, services_arn):
+        missing_arns = [arn for arn in services_arn if arn not in self.__repository_name_by_arn]
+        task_definitions = get_task_definitions(
+            [self.services_by_arn[arn]['taskDefinition'] for arn in missing_arns])
+        for arn in missing_arns:
+            self.__repository_name_by_arn[arn] = get_repository_name_from_task_definition(
+                task_definitions[self.services_by_arn[arn]['taskDefinition']])
+        return {arn: self.__repository_name_by_arn[arn] for arn in services_arn}
+
+    def get_services_arn_for_repository(self, repository_name, color=None):
+        services_arn = self.get_services_arn_for_color(color) if color else self.services_arn
+        repository_names = self.get_repository_names(services_arn)
+        return [arn for arn in services_arn if repository_names[arn] == repository_name]
+
+
+__inventories = {}
+__inventories_lock = threading.Lock()
+# Les révisions de task definition sont immuables : cache arn de révision -> task definition
+__task_definitions = {}
+
+
+# Récupère l'inventaire d'un cluster, reconstruit s'il est plus vieux que son TTL
+def get_cluster_inventory(cluster_name, ttl=constant.ECS_INVENTORY_TTL):
+    with __inventories_lock:
+        inventory = __inventories.get(cluster_name)
+        if inventory is None or inventory.is_expired():
+            inventory = ClusterInventory(cluster_name, ttl)
+            __inventories[cluster_name] = inventory
+        return inventory
+
+
+# Oublie l'inventaire d'un cluster (ou de tous) : le prochain get_cluster_inventory le reconstruit
+# build_deployment_manager l'appelle à chaque construction, un inventaire ne sert donc qu'à une invocation
+def clear_cluster_inventory(cluster_name=None):
+    with __inventories_lock:
+        if cluster_name is None:
+            __inventories.clear()
+        else:
+            __inventories.pop(cluster_name, None)
+
+
+# Récupère des task definitions par arn de révision, sans doublon et en parallèle pour celles absentes du cache
+def get_task_definitions(task_definitions_arn, max_workers=constant.BUILD_MAX_WORKERS):
+    missing_arns = [arn for arn in dict.fromkeys(task_definitions_arn) if arn not in __task_definitions]
+    if missing_arns:
+        with instrumentation.TracedThreadPoolExecutor(max_workers=min(max_workers, len(missing_arns))) as executor:
+            for arn, task_definition in zip(missing_arns, executor.map(__describe_task_definition, missing_arns)):
+                __task_definitions[arn] = task_definition
+    return {arn: __task_definitions[arn] for arn in task_definitions_arn}
+
+
+def __describe_task_definition(task_definition_arn):
+    return clients.get_client('ecs').describe_task_definition(taskDefinition=task_definition_arn)['taskDefinition']
+
+
+# Liste les services du cluster sans passer par l'inventaire : le seul appelant (reconstruction depuis un instantané,
+# cf. deployment_manager_factory) n'a besoin que des arn et évite ainsi les describe_services de l'inventaire
 def get_services_from_cluster(cluster_name, max_results=100):
-    return ecs_client.list_services(
-        cluster=cluster_name,
-        maxResults=max_results
-    )
+    return {
+        'serviceArns': list(common.paginate(clients.get_client('ecs'), 'list_services', 'serviceArns',
+                                            page_size=max_results, cluster=cluster_name))
+    }
 
 
 def get_services_arn_from_query(q, cluster_name):
-    founded_services = []
-    services = get_services_from_cluster(cluster_name)
-    for service_arn in services['serviceArns']:
-        if q.upper() in service_arn.upper():
-            founded_services.append(service_arn)
-    return founded_services
+    return get_cluster_inventory(cluster_name).get_services_arn_from_query(q)
 
 
 # Récupère les arn de tous les services ecs d'un cluster pour une couleur donnée
 def get_services_arn_for_color(color, cluster_name):
-    colored_services = []
-    services = get_services_from_cluster(cluster_name)
-    for service_arn in services['serviceArns']:
-        if color.upper() in service_arn.upper():
-            colored_services.append(service_arn)
-    return colored_services
+    return get_cluster_inventory(cluster_name).get_services_arn_for_color(color)
 
 
 def get_service_max_capacity_from_service_arn(service_arn):
-    tag_description_result = ecs_client.list_tags_for_resource(resourceArn=service_arn)
-    tags = tag_description_result.get('tags')
+    tag_description_result = clients.get_client('ecs').list_tags_for_resource(resourceArn=service_arn)
+    return get_max_capacity_from_tags(tag_description_result.get('tags'))
+
+
+def get_max_capacity_from_tags(tags):
     max_capacity_value = None
-    for i in range(len(tags)):
-        if tags[i].get("key") == "MaxCapacity":
-            max_capacity_value = int(tags[i].get("value"))
+    for tag in tags or []:
+        if tag.get("key") == "MaxCapacity":
+            max_capacity_value = int(tag.get("value"))
             break
 
     return max_capacity_value or constant.DEFAULT_MAX_CAPACITY
@@ -50,35 +144,28 @@ def get_service_resource_id_from_service_arn(service_arn):
     return str(service_arn).split(':')[5]
 
 
+# Extrait le nom du repository de l'image du premier conteneur
+# (ex: 721041490777.dkr.ecr.us-east-1.amazonaws.com/lcdp-api-gateway:BLUE)
+def get_repository_name_from_task_definition(task_definition):
+    container_definitions = task_definition['containerDefinitions']
+    if container_definitions:
+        return common.get_repository_name_from_image(container_definitions[0]['image'])
+
+
 # récupère le nom du repository de l'image des services
 def get_map_of_repo_name_service(color, cluster_name):
+    inventory = get_cluster_inventory(cluster_name)
     repo_name_service_map = {}
-    services = get_services_from_cluster(cluster_name)
-    for service_arn in services['serviceArns']:
-        if color.upper() in service_arn.upper():
-            service = ecs_client.describe_services(
-                cluster=cluster_name,
-                services=[service_arn]
-            )
-            taskDefinition = ecs_client.describe_task_definition(
-                taskDefinition=service['services'][0]['taskDefinition']
-            )
-            containerDefinitions = taskDefinition['taskDefinition']['containerDefinitions']
-
-            if containerDefinitions:
-                image = containerDefinitions[0]['image']
-
-                # Extrait le nom du repository de l'image
-                # (ex: 721041490777.dkr.ecr.us-east-1.amazonaws.com/lcdp-api-gateway:BLUE)
-                repository_name = image.split('/')[-1].split(':')[0]
-
-                ecsService = EcsService(ecs_client=ecs_client,
-                                        application_autoscaling_client=application_autoscaling_client,
-                                        cluster_name=cluster_name,
-                                        service_arn=service_arn,
-                                        max_capacity=get_service_max_capacity_from_service_arn(service_arn),
-                                        resource_id=get_service_resource_id_from_service_arn(service_arn))
-
-                repo_name_service_map[repository_name] = ecsService
+    repository_names = inventory.get_repository_names(inventory.get_services_arn_for_color(color))
+    for service_arn, repository_name in repository_names.items():
+        if repository_name:
+            ecsService = EcsService(ecs_client=clients.get_client('ecs'),
+                                    application_autoscaling_client=clients.get_client('application-autoscaling'),
+                                    cluster_name=cluster_name,
+                                    service_arn=service_arn,
+                                    max_capacity=inventory.get_max_capacity(service_arn),
+                                    resource_id=get_service_resource_id_from_service_arn(service_arn))
+
+            repo_name_service_map[repository_name] = ecsService
 
     return repo_name_service_map
@@ -1,11 +1,9 @@
-import boto3
 from . import constant as constant
-
-ses_client = boto3.client('ses', region_name='eu-central-1')
+from . import clients as clients
 
 
 def send_mail_to_developers(message_content):
-    ses_client.send_email(
+    clients.get_client('ses', region_name=constant.SES_REGION).send_email(
         Source=constant.FROM_MAIL,
         Destination=__build_destination(),
         Message=__build_message_from_content(message_content)
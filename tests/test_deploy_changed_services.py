@@ -0,0 +1,110 @@
+import unittest
+from unittest import mock
+
+from lcdp_deployment_manager import deployment_executor
+
+IMAGE_PREFIX = '1.dkr.ecr.eu-west-1.amazonaws.com/'
+
+
+class FakeService:
+    def __init__(self, name):
+        self.service_arn = 'arn:aws:ecs:eu-west-1:1:service/cluster/{}-blue'.format(name)
+        self.new_deployments = 0
+
+    def request_new_deployment(self):
+        self.new_deployments += 1
+
+
+class FakeRepository:
+    def __init__(self, name, digest):
+        self.name = name
+        self.image = {'imageTag': 'BLUE', 'imageDigest': digest}
+
+
+class FakeDeploymentManager:
+    def __init__(self, repositories):
+        self.repositories = repositories
+        self.tagged_repositories = None
+
+    def add_tag_to_repositories(self, tags, repositories_name=None):
+        self.tagged_repositories = set(repositories_name)
+
+
+class FakeEnvironment:
+    color = 'blue'
+    cluster_name = 'cluster'
+
+    def __init__(self, services, containers_by_service_arn):
+        self.ecs_services = services
+        self.containers_by_service_arn = containers_by_service_arn
+        self.started_services = []
+        self.healthy_checked_services = []
+
+    def get_running_containers(self):
+        return self.containers_by_service_arn
+
+    def enable_rollout_verification(self, services=None):
+        pass
+
+    def start_up_services(self, services=None, max_workers=None):
+        self.started_services.extend(services)
+
+    def wait_for_services_health(self, services=None):
+        self.healthy_checked_services.extend(services)
+
+
+class FakeInventory:
+    def __init__(self, repository_name_by_arn):
+        self.repository_name_by_arn = repository_name_by_arn
+
+    def get_repository_names(self, services_arn):
+        return {arn: self.repository_name_by_arn[arn] for arn in services_arn}
+
+
+class DeployChangedServicesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.running = FakeService('lcdp-api')
+        self.stopped = FakeService('lcdp-front')
+        self.unchanged = FakeService('lcdp-auth')
+        self.services = [self.running, self.stopped, self.unchanged]
+        self.deployment_manager = FakeDeploymentManager([
+            FakeRepository('lcdp-api', 'sha256:new-api'),
+            FakeRepository('lcdp-front', 'sha256:new-front'),
+            FakeRepository('lcdp-auth', 'sha256:auth'),
+        ])
+        self.environment = FakeEnvironment(self.services, {
+            self.running.service_arn: [{'image': IMAGE_PREFIX + 'lcdp-api:BLUE', 'imageDigest': 'sha256:old-api'}],
+            self.stopped.service_arn: [],
+            self.unchanged.service_arn: [{'image': IMAGE_PREFIX + 'lcdp-auth:BLUE', 'imageDigest': 'sha256:auth'}],
+        })
+        inventory = FakeInventory({s.service_arn: n for s, n in zip(self.services, ['lcdp-api', 'lcdp-front',
+                                                                                    'lcdp-auth'])})
+        patcher = mock.patch.object(deployment_executor.ecs_manager, 'get_cluster_inventory',
+                                    return_value=inventory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_service_with_tasks_is_redeployed_in_place(self):
+        deployment_executor.deploy_changed_services(self.deployment_manager, self.environment)
+
+        self.assertEqual(self.running.new_deployments, 1)
+        self.assertNotIn(self.running, self.environment.started_services)
+
+    def test_stopped_service_is_started(self):
+        deployment_executor.deploy_changed_services(self.deployment_manager, self.environment)
+
+        self.assertEqual(self.environment.started_services, [self.stopped])
+        self.assertEqual(self.stopped.new_deployments, 0)
+
+    def test_only_changed_services_are_tagged_and_waited_for(self):
+        changed_services = deployment_executor.deploy_changed_services(self.deployment_manager, self.environment)
+
+        self.assertEqual(changed_services, [self.running, self.stopped])
+        self.assertEqual(self.deployment_manager.tagged_repositories, {'lcdp-api', 'lcdp-front'})
+        self.assertEqual(self.environment.healthy_checked_services, [self.running, self.stopped])
+        self.assertEqual(self.unchanged.new_deployments, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
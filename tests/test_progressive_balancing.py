@@ -0,0 +1,83 @@
+import unittest
+from unittest import mock
+
+from lcdp_deployment_manager import deployment_executor
+
+BLUE_TARGET_GROUP = 'arn:tg/blue'
+GREEN_TARGET_GROUP = 'arn:tg/green'
+
+
+class FakeEnvironment:
+    target_group_type = 'default'
+
+    def __init__(self, color, target_group_arn):
+        self.color = color
+        self.target_group_arn = target_group_arn
+
+
+class FakeDeploymentManager:
+    def __init__(self, fail_on_target_group=None):
+        self.rules = [{'RuleArn': 'arn:rule/1'}]
+        self.calls = []
+        self.fail_on_target_group = fail_on_target_group
+
+    def get_rules_with_type_and_color(self, expected_type, expected_color):
+        return self.rules
+
+    def update_rules_weights(self, rules, weights):
+        self.calls.append(('weights', weights[GREEN_TARGET_GROUP]))
+
+    def update_rules_target_group(self, rules, target_group_arn):
+        self.calls.append(('target_group', target_group_arn))
+        if target_group_arn == self.fail_on_target_group:
+            raise Exception('Unable to switch 1 rule(s)')
+
+
+class ProgressiveBalancingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.blue = FakeEnvironment('blue', BLUE_TARGET_GROUP)
+        self.green = FakeEnvironment('green', GREEN_TARGET_GROUP)
+
+    def balance(self, deployment_manager, steps, breaches=()):
+        breaches = list(breaches)
+        with mock.patch.object(deployment_executor, '_hold_and_check_canary',
+                               side_effect=lambda *args: breaches.pop(0) if breaches else None):
+            deployment_executor.do_progressive_balancing(deployment_manager, self.blue, self.green, steps=steps)
+
+    def test_shifts_every_step_then_switches(self):
+        deployment_manager = FakeDeploymentManager()
+
+        self.balance(deployment_manager, (5, 50, 100))
+
+        self.assertEqual(deployment_manager.calls,
+                         [('weights', 5), ('weights', 50), ('target_group', GREEN_TARGET_GROUP)])
+
+    def test_rejects_steps_not_ending_at_100(self):
+        for steps in ((5, 25, 50), (), (50, 25, 100), (0, 100), (50, 150)):
+            deployment_manager = FakeDeploymentManager()
+            with self.assertRaisesRegex(Exception, 'Invalid progressive balancing steps'):
+                self.balance(deployment_manager, steps)
+            self.assertEqual(deployment_manager.calls, [])
+
+    def test_rolls_back_on_breach_at_intermediate_step(self):
+        deployment_manager = FakeDeploymentManager()
+
+        with self.assertRaisesRegex(Exception, 'rolled back at 50%'):
+            self.balance(deployment_manager, (5, 50, 100), breaches=[None, 'p95 latency 3.000s above 2.0s'])
+
+        self.assertEqual(deployment_manager.calls,
+                         [('weights', 5), ('weights', 50), ('target_group', BLUE_TARGET_GROUP)])
+
+    def test_rolls_back_on_failure_at_100_percent_step(self):
+        deployment_manager = FakeDeploymentManager(fail_on_target_group=GREEN_TARGET_GROUP)
+
+        with self.assertRaisesRegex(Exception, 'Unable to switch'):
+            self.balance(deployment_manager, (5, 100))
+
+        self.assertEqual(deployment_manager.calls,
+                         [('weights', 5), ('target_group', GREEN_TARGET_GROUP), ('target_group', BLUE_TARGET_GROUP)])
+
+
+if __name__ == '__main__':
+    unittest.main()
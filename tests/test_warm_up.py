@@ -0,0 +1,64 @@
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lcdp_deployment_manager import deployment_executor
+
+
+class DelayedHandler(BaseHTTPRequestHandler):
+    delay = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeEnvironment:
+    color = 'blue'
+
+
+class WarmUpEnvironmentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), DelayedHandler)
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        DelayedHandler.delay = 0
+
+    def warm_up(self, p95_target, timeout):
+        return deployment_executor.warm_up_environment(None, FakeEnvironment(), paths=('/', '/health'),
+                                                       p95_target=p95_target, timeout=timeout,
+                                                       requests_per_round=8, base_urls=[self.base_url])
+
+    def test_returns_once_p95_is_under_target(self):
+        DelayedHandler.delay = 0.01
+
+        p95_latency = self.warm_up(p95_target=0.5, timeout=5)
+
+        self.assertGreaterEqual(p95_latency, 0.01)
+        self.assertLessEqual(p95_latency, 0.5)
+
+    def test_times_out_when_p95_stays_above_target(self):
+        DelayedHandler.delay = 0.1
+        start_time = time.time()
+
+        with self.assertRaisesRegex(Exception, 'did not reach p95'):
+            self.warm_up(p95_target=0.05, timeout=1)
+
+        self.assertLess(time.time() - start_time, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()